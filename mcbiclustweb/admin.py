@@ -1,3 +1,37 @@
+import csv
+
 from django.contrib import admin
+from django.http import HttpResponse
+
+from mcbiclustweb.models import Analysis, ApiToken, StageMetric
 
 # Register your models here.
+
+METRIC_FIELDS = ['id', 'analysis_id', 'stage', 'wall_time', 'cpu_time', 'peak_rss', 'genes', 'samples', 'runs', 'seed_size', 'iterations', 'date_recorded']
+
+def export_csv(modeladmin, request, queryset):
+    response = HttpResponse(content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="stage_metrics.csv"'
+    writer = csv.writer(response)
+    writer.writerow(METRIC_FIELDS)
+    for row in queryset.order_by('id').values_list(*METRIC_FIELDS):
+        writer.writerow(row)
+    return response
+export_csv.short_description = "Export selected stage metrics as CSV"
+
+@admin.register(StageMetric)
+class StageMetricAdmin(admin.ModelAdmin):
+    list_display = ['analysis', 'stage', 'wall_time', 'cpu_time', 'peak_rss', 'genes', 'samples', 'runs', 'seed_size', 'iterations', 'date_recorded']
+    list_filter = ['stage']
+    search_fields = ['analysis__name']
+    actions = [export_csv]
+
+@admin.register(Analysis)
+class AnalysisAdmin(admin.ModelAdmin):
+    list_display = ['name', 'user', 'stage', 'status', 'date_started']
+    list_filter = ['stage']
+
+@admin.register(ApiToken)
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ['user', 'name', 'date_created', 'last_used']
+    exclude = ['key_hash']
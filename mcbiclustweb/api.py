@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import secrets
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+
+from mcbiclustweb import cancellation, costmodel, scheduler
+from mcbiclustweb.forms import CreateAnalysisForm
+from mcbiclustweb.models import Analysis, ApiToken, Artifact
+from mcbiclustweb.tasks import dispatchAnalyses, fork_plot_render, preprocess
+
+# JSON API for pipelines. Requests carry "Authorization: Token <key>", each token may make
+# MCBICLUST_API_RATE_LIMIT requests per window and only sees the analyses of its user.
+
+STATUS_FIELDS = ['id', 'name', 'stage', 'status', 'progress_done', 'progress_total', 'queued_at', 'date_started']
+
+
+def token_hash(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def create_token(profile, name=""):
+    # The key is only returned here, the database keeps its hash
+    key = secrets.token_hex(20)
+    token = ApiToken.objects.create(user=profile, name=name, key_hash=token_hash(key))
+    return token, key
+
+
+def error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+def throttle(token):
+    # Seconds until the token may make requests again, None while it is under its limit.
+    # Requests are counted in the Django cache per fixed window.
+    limit, window = settings.MCBICLUST_API_RATE_LIMIT
+    now = time.time()
+    key = 'mcbiclustweb-api-{0}-{1}'.format(token.id, int(now // window))
+    cache.add(key, 0, window)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # The window expired between add and incr
+        cache.set(key, 1, window)
+        count = 1
+    if count > limit:
+        return int(window - now % window) + 1
+    return None
+
+
+def api_view(*methods):
+    # Token authentication, rate limiting and the allowed methods. The view gets the token's Profile.
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            header = request.META.get('HTTP_AUTHORIZATION', '')
+            if not header.startswith('Token '):
+                return error("authentication required", 401)
+            token = ApiToken.objects.select_related('user').filter(key_hash=token_hash(header[len('Token '):].strip())).first()
+            if token is None:
+                return error("invalid token", 401)
+            retry = throttle(token)
+            if retry is not None:
+                response = error("rate limit exceeded", 429)
+                response['Retry-After'] = str(retry)
+                return response
+            if request.method not in methods:
+                return error("method not allowed", 405)
+            ApiToken.objects.filter(id=token.id).update(last_used=timezone.now())
+            return view(request, token.user, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def status_values(a):
+    return {'id': a['id'], 'name': a['name'], 'stage': a['stage'], 'status': a['status'], 'progress_done': a['progress_done'],
+            'progress_total': a['progress_total'], 'queued': a['queued_at'] is not None, 'date_started': a['date_started'].isoformat()}
+
+
+@api_view('POST')
+def create(request, profile):
+    # New analysis from a multipart upload of name, description and gem, preprocessed as from the index page
+    form = CreateAnalysisForm(request.POST)
+    if 'gem' not in request.FILES:
+        return error("gem file required", 400)
+    if not form.is_valid():
+        return JsonResponse({'error': "invalid analysis", 'fields': form.errors}, status=400)
+    a = form.save(commit=False)
+    a.user = profile
+    a.status = "1. Preprocessing"
+    a.save()
+    a.gem = request.FILES['gem']
+    a.save()
+    result = preprocess.delay(a.id)
+    cancellation.track(a.id, [result.id])
+    return JsonResponse({'id': a.id, 'stage': a.stage, 'status': a.status}, status=201)
+
+
+@api_view('POST')
+def start(request, profile, analysis_id):
+    # Start or restart an analysis. JSON body with seed_size, iterations, num_runs, geneset (a
+    # list of genes), optionally init_seed (comma separated samples) and confirm.
+    a = Analysis.objects.filter(id=analysis_id, user=profile).first()
+    if a is None:
+        return error("analysis not found", 404)
+    # The stages the analysis page offers to start or restart from
+    if not (a.stage < 3 and a.stage not in (1, -2) or a.stage == 12):
+        return error("analysis cannot be started at stage {0}".format(a.stage), 409)
+    try:
+        params = json.loads(request.body.decode('utf-8'))
+        seed_size = int(params['seed_size'])
+        iterations = int(params['iterations'])
+        num_runs = int(params['num_runs'])
+        init_seed = str(params.get('init_seed', ""))
+        geneset = [str(gene).strip() for gene in params['geneset'] if str(gene).strip()]
+    except (ValueError, KeyError, TypeError):
+        return error("seed_size, iterations, num_runs and geneset are required", 400)
+    if min(seed_size, iterations, num_runs) < 1 or not geneset:
+        return error("seed_size, iterations and num_runs must be positive and geneset not empty", 400)
+
+    e = costmodel.estimate(a, seed_size, iterations, num_runs, len(geneset))
+    decision, message = costmodel.admit(a, e)
+    if decision == 'refuse' or (decision == 'confirm' and not params.get('confirm')):
+        return JsonResponse({'error': message, 'decision': decision, 'estimate': e}, status=403)
+
+    cancellation.cancel(a)
+    scheduler.enqueue(a, {'seed_size': seed_size, 'init_seed': init_seed, 'geneset': geneset, 'iterations': iterations, 'num_runs': num_runs})
+    dispatchAnalyses.delay()
+    return JsonResponse({'id': a.id, 'stage': a.stage, 'status': a.status, 'estimate': e}, status=202)
+
+
+@api_view('GET', 'POST')
+def status(request, profile):
+    # Status of many analyses, ids as ?ids=1,2,3 or a JSON body {"ids": [...]}, in one query
+    # on the (user, id) index. Ids that are not the user's are returned as missing.
+    try:
+        if request.method == 'POST':
+            ids = [int(i) for i in json.loads(request.body.decode('utf-8'))['ids']]
+        else:
+            ids = [int(i) for i in request.GET.get('ids', '').split(',') if i.strip()]
+    except (ValueError, KeyError, TypeError):
+        return error("ids must be a list of analysis ids", 400)
+    if len(ids) > settings.MCBICLUST_API_MAX_IDS:
+        return error("at most {0} ids per request".format(settings.MCBICLUST_API_MAX_IDS), 400)
+    found = {a['id']: status_values(a) for a in Analysis.objects.filter(user=profile, id__in=ids).values(*STATUS_FIELDS)}
+    return JsonResponse({'analyses': [found[i] for i in ids if i in found], 'missing': [i for i in ids if i not in found]})
+
+
+@api_view('GET')
+def artifacts(request, profile, analysis_id):
+    if not Analysis.objects.filter(id=analysis_id, user=profile).exists():
+        return error("analysis not found", 404)
+    rows = Artifact.objects.filter(analysis_id=analysis_id).values('kind', 'path', 'bicluster', 'characteristic', 'size', 'checksum')
+    return JsonResponse({'artifacts': [dict(row, rendered=row['size'] is not None,
+                                            url=reverse('mcbiclustweb:api_artifact', args=[analysis_id, row['path']])) for row in rows]})
+
+
+@api_view('GET')
+def artifact(request, profile, analysis_id, path):
+    # Only files in the manifest can be downloaded. Fork plots not rendered yet are sent to be
+    # rendered and answered with 202 until they are.
+    a = Analysis.objects.filter(id=analysis_id, user=profile).only('id', 'user_id').first()
+    entry = Artifact.objects.filter(analysis_id=analysis_id, path=path).first() if a is not None else None
+    if entry is None:
+        return error("artifact not found", 404)
+    if entry.size is None:
+        if entry.kind != 'forkplot':
+            return error("artifact not written yet", 404)
+        # The render runs on a worker, the client asks again until the file is there
+        result = fork_plot_render(entry)
+        if result.failed():
+            return error("fork plot could not be rendered", 404)
+        response = JsonResponse({'status': "rendering"}, status=202)
+        response['Retry-After'] = '5'
+        return response
+    store_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user_id, a.id))
+    return FileResponse(open(os.path.join(store_dir, entry.path), 'rb'), as_attachment=True, filename=os.path.basename(entry.path))
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache as counters
+
+# Content-addressed cache of analysis stage results, shared by all analyses. An entry is a
+# directory of .npy arrays and copied files, named by the hash of everything the stage depends
+# on: the preprocessed GEM contents, the parameters and the key of the stage it builds on.
+# The mtime of an entry is its last use. evict removes the least recently used entries once the
+# cache is over MCBICLUST_CACHE_MAX_BYTES. Celery beat runs it periodically, put runs it as
+# soon as a running estimate of the size (the last evicted size plus the entries stored since,
+# kept in the Django cache) goes over.
+
+SIZE_KEY = 'mcbiclustweb-cache-bytes'
+
+
+def cache_dir():
+    return os.path.join(settings.MEDIA_ROOT, 'cache')
+
+
+def key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def entry_dir(stage_key):
+    return os.path.join(cache_dir(), stage_key[:2], stage_key)
+
+
+def get(stage_key):
+    # Directory of a cached stage, or None
+    path = entry_dir(stage_key)
+    if not os.path.isdir(path):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def arrays(entry):
+    return {name[:-4]: np.load(os.path.join(entry, name)) for name in os.listdir(entry) if name.endswith('.npy')}
+
+
+def restore_files(entry, dest_dir):
+    # Copy the cached files (plots) of an entry back into an analysis directory
+    for name in os.listdir(entry):
+        if not name.endswith('.npy'):
+            shutil.copy(os.path.join(entry, name), os.path.join(dest_dir, name))
+
+
+def put(stage_key, arrays=None, files=()):
+    path = entry_dir(stage_key)
+    if os.path.isdir(path):
+        return
+    # Written next to its final name and renamed, so readers never see half an entry
+    tmp = '{0}.tmp{1}'.format(path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for name, value in (arrays or {}).items():
+        np.save(os.path.join(tmp, name + '.npy'), value)
+    for f in files:
+        shutil.copy(f, tmp)
+    size = entry_size(tmp)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another worker stored the same stage first
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    counters.add(SIZE_KEY, 0, None)
+    try:
+        estimate = counters.incr(SIZE_KEY, size)
+    except ValueError:
+        estimate = size
+    if estimate > settings.MCBICLUST_CACHE_MAX_BYTES:
+        evict()
+
+
+def entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def evict(max_bytes=None):
+    # Scans the whole cache, returns its size once trimmed
+    if max_bytes is None:
+        max_bytes = settings.MCBICLUST_CACHE_MAX_BYTES
+    if not os.path.isdir(cache_dir()):
+        counters.set(SIZE_KEY, 0, None)
+        return 0
+    entries = []
+    for prefix in os.listdir(cache_dir()):
+        for name in os.listdir(os.path.join(cache_dir(), prefix)):
+            path = os.path.join(cache_dir(), prefix, name)
+            if '.tmp' in name:
+                continue
+            try:
+                entries.append((os.path.getmtime(path), entry_size(path), path))
+            except OSError:
+                pass
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+    counters.set(SIZE_KEY, total, None)
+    return total
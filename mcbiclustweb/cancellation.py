@@ -0,0 +1,40 @@
+import json
+
+from celery import current_app
+from django.db import transaction
+from django.db.models import F
+
+from mcbiclustweb.models import Analysis
+
+# Cooperative cancellation. Each start of an analysis is a generation of it, the tasks of a run
+# carry their generation and stop at the next check once the analysis is restarted (a new
+# generation) or deleted. Tasks still waiting in the broker are revoked outright.
+
+
+def requested(analysis_id, generation=None):
+    # True once the analysis is deleted, or restarted since this generation was started.
+    # Without a generation (tasks run outside a queued start) only deletion counts.
+    analyses = Analysis.objects.filter(id=analysis_id)
+    if generation is not None:
+        analyses = analyses.filter(generation=generation)
+    return not analyses.exists()
+
+
+def track(analysis_id, task_ids):
+    # Keep the ids of tasks sent for the analysis, to revoke them if it is cancelled
+    with transaction.atomic():
+        current = Analysis.objects.select_for_update().filter(id=analysis_id).values_list('task_ids', flat=True).first()
+        if current is None:
+            return
+        Analysis.objects.filter(id=analysis_id).update(task_ids=json.dumps(json.loads(current or '[]') + list(task_ids)))
+
+
+def cancel(a):
+    # Stop the current run of the analysis and take it off the queue, freeing its slot
+    with transaction.atomic():
+        current = Analysis.objects.select_for_update().filter(id=a.id).values_list('task_ids', flat=True).first()
+        Analysis.objects.filter(id=a.id).update(generation=F('generation') + 1, task_ids='', queued_at=None, dispatched_at=None)
+    task_ids = json.loads(current or '[]')
+    if task_ids:
+        current_app.control.revoke(task_ids)
+    a.refresh_from_db(fields=['generation', 'task_ids', 'queued_at', 'dispatched_at'])
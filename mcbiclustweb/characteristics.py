@@ -0,0 +1,96 @@
+import re
+import numpy as np
+
+# Values seen fewer times than this are rare
+RARE_COUNT = 5
+# Columns where more than this fraction of the known values are rare are dropped
+RARE_FRACTION = 0.8
+
+R_RESERVED = {'if', 'else', 'repeat', 'while', 'function', 'for', 'next', 'break', 'TRUE', 'FALSE', 'NULL',
+              'Inf', 'NaN', 'NA', 'NA_integer_', 'NA_real_', 'NA_character_', 'in'}
+
+
+def normalise(values):
+    # Strip whitespace, empty values become "unknown" and every spelling of none becomes "none"
+    # Object dtype, so replacements are not truncated to the width of the input strings
+    values = np.char.strip(np.asarray(values, dtype=str)).astype(object)
+    values[values == ""] = "unknown"
+    values[np.isin(values, ["None", "NONE", "none"])] = "none"
+    return values
+
+
+def keep_column(values):
+    # Drop columns with a single value, or where most values (ignoring "unknown") are rare
+    uniques, counts = np.unique(values, return_counts=True)
+    if len(uniques) == 1:
+        return False
+    known = uniques != "unknown"
+    return np.count_nonzero(counts[known] < RARE_COUNT) / np.count_nonzero(known) <= RARE_FRACTION
+
+
+def collapse_rare(values):
+    # Values seen fewer than RARE_COUNT times become "Other", unless only one value is rare
+    uniques, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    rare = counts < RARE_COUNT
+    if np.count_nonzero(rare) <= 1:
+        return values
+    values = values.copy()
+    values[rare[inverse.ravel()]] = "Other"
+    return values
+
+
+def clean(names, columns):
+    # All three steps over a table of columns, returning the columns that are kept
+    kept_names = []
+    kept = []
+    for name, values in zip(names, columns):
+        values = normalise(values)
+        if keep_column(values):
+            kept_names.append(name)
+            kept.append(collapse_rare(values))
+    return kept_names, kept
+
+
+def make_unique(names):
+    # R's make.unique: later duplicates get .1, .2, ... appended
+    seen = set(names)
+    counts = {}
+    out = []
+    used = set()
+    for name in names:
+        if name in used:
+            k = counts.get(name, 0)
+            while True:
+                k += 1
+                candidate = '{0}.{1}'.format(name, k)
+                if candidate not in seen:
+                    break
+            counts[name] = k
+            seen.add(candidate)
+            name = candidate
+        used.add(name)
+        out.append(name)
+    return out
+
+
+def make_names(names):
+    # R's make.names(unique=TRUE), which data.frame applies to its column names
+    out = []
+    for name in names:
+        name = re.sub(r'[^\w.]', '.', name)
+        if not re.match(r'[^\W\d_]|\.(?!\d)', name):
+            name = 'X' + name
+        if name in R_RESERVED:
+            name = name + '.'
+        out.append(name)
+    return make_unique(out)
+
+
+def write_table(path, names, columns):
+    # Same text as R's write.table of a data.frame of character columns with default row names
+    def quote(x):
+        return '"' + x.replace('"', '\\"') + '"'
+    with open(path, 'w') as f:
+        f.write(' '.join(quote(name) for name in names) + '\n')
+        for i, row in enumerate(zip(*columns)):
+            f.write(' '.join([quote(str(i + 1))] + [quote(value) for value in row]) + '\n')
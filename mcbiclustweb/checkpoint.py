@@ -0,0 +1,47 @@
+import os
+import shutil
+import numpy as np
+
+# Stage results of an analysis, kept in its own directory so a restart or a redelivered task
+# resumes after the last completed stage. Each checkpoint stores the key of the stage (the
+# same hash of GEM contents and parameters used by the cache) and is only used if it matches.
+CHECKPOINT_DIR = 'checkpoints'
+RUN_FILE = 'run.key'
+
+
+def checkpoint_dir(store_dir):
+    return os.path.join(store_dir, CHECKPOINT_DIR)
+
+
+def reset(store_dir, run_key):
+    # Start of an analysis run: drop the checkpoints of a run with other inputs
+    path = checkpoint_dir(store_dir)
+    try:
+        with open(os.path.join(path, RUN_FILE)) as f:
+            if f.read().strip() == run_key:
+                return
+    except OSError:
+        pass
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    with open(os.path.join(path, RUN_FILE), 'w') as f:
+        f.write(run_key)
+
+
+def save(store_dir, stage, stage_key, arrays):
+    path = os.path.join(checkpoint_dir(store_dir), stage + '.npz')
+    tmp = '{0}.tmp{1}.npz'.format(path[:-4], os.getpid())
+    os.makedirs(checkpoint_dir(store_dir), exist_ok=True)
+    np.savez(tmp, _key=np.array(stage_key), **arrays)
+    os.replace(tmp, path)
+
+
+def load(store_dir, stage, stage_key):
+    # Arrays saved for the stage, or None when missing or saved for other inputs
+    try:
+        with np.load(os.path.join(checkpoint_dir(store_dir), stage + '.npz')) as f:
+            if str(f['_key']) != stage_key:
+                return None
+            return {name: f[name] for name in f.files if name != '_key'}
+    except (OSError, KeyError, ValueError):
+        return None
@@ -0,0 +1,149 @@
+import datetime
+import json
+import os
+from math import ceil
+
+import numpy as np
+from scipy.optimize import nnls
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+
+from mcbiclustweb import gemstore
+from mcbiclustweb.models import Analysis, StageMetric
+
+# Runtime and peak memory of an analysis predicted from the recorded stage metrics. Each
+# stage's wall time and peak RSS are fitted by non-negative least squares on the sizes its
+# work scales with. FindSeed rows are per run, with the gene set size as their number of
+# genes, and bicluster rows are per bicluster.
+
+STAGE_FEATURES = {
+    'findseed': lambda d: [1, d['iterations'], d['iterations'] * d['genes'] * d['seed_size']],
+    'cormat': lambda d: [1, d['genes'] * d['samples'] * d['runs']],
+    'heatmap': lambda d: [1, d['genes'] * d['runs'], d['runs'] ** 2],
+    'clusters': lambda d: [1, d['genes'] * d['runs'], d['runs'] ** 2],
+    'cvplot': lambda d: [1, d['genes']],
+    'bicluster': lambda d: [1, d['genes'] * d['samples'], d['samples'] ** 2],
+    'forkdata': lambda d: [1, d['samples']],
+}
+MEMORY_FEATURES = lambda d: [1, d['genes'] * d['samples'], d['genes'] * d['runs']]
+
+# Biclusters assumed per analysis, SilhouetteClustGroups usually finds two or three
+BICLUSTERS = 3
+
+# Most recent rows of each stage the model is fitted on, and how long a fit is kept
+FIT_ROWS = 2000
+MODEL_CACHE_KEY = 'mcbiclustweb-cost-model'
+MODEL_CACHE_SECONDS = 3600
+
+
+def least_squares(X, y):
+    # Non-negative coefficients, a stage does not get cheaper as its input grows. The sizes
+    # span many orders of magnitude, so each column is scaled to at most 1 for the solver.
+    X = np.array(X, dtype=np.float64)
+    scale = np.abs(X).max(axis=0)
+    scale[scale == 0] = 1
+    return (nnls(X / scale, np.array(y, dtype=np.float64))[0] / scale).tolist()
+
+
+def fit():
+    model = {}
+    for stage, features in STAGE_FEATURES.items():
+        X, wall, X_memory, memory = [], [], [], []
+        for row in StageMetric.objects.filter(stage=stage).order_by('-id').values('genes', 'samples', 'runs', 'seed_size', 'iterations', 'wall_time', 'peak_rss')[:FIT_ROWS]:
+            try:
+                x = features(row)
+                x_memory = MEMORY_FEATURES(dict(row, runs=row['runs'] or 1))
+            except TypeError:
+                # Rows without the sizes this stage needs
+                continue
+            X.append(x)
+            wall.append(row['wall_time'])
+            X_memory.append(x_memory)
+            memory.append(row['peak_rss'])
+        if len(X) >= len(features(dict.fromkeys(['genes', 'samples', 'runs', 'seed_size', 'iterations'], 1))):
+            model[stage] = {'time': least_squares(X, wall), 'memory': least_squares(X_memory, memory)}
+    return model
+
+
+def get_model():
+    model = cache.get(MODEL_CACHE_KEY)
+    if model is None:
+        model = fit()
+        cache.set(MODEL_CACHE_KEY, model, MODEL_CACHE_SECONDS)
+    return model
+
+
+def predict(model, genes, samples, geneset_size, seed_size, iterations, runs):
+    # Worker seconds of all stages, wall clock seconds with the runs spread over
+    # MCBICLUST_SEED_WORKERS, and peak RSS in KB. None until FindSeed runs have been recorded.
+    if 'findseed' not in model:
+        return None
+    dims = {'genes': genes, 'samples': samples, 'runs': runs, 'seed_size': seed_size, 'iterations': iterations}
+    run_dims = dict(dims, genes=geneset_size, runs=1)
+    run_time = float(np.dot(model['findseed']['time'], STAGE_FEATURES['findseed'](run_dims)))
+    compute = run_time * runs
+    runtime = run_time * ceil(runs / settings.MCBICLUST_SEED_WORKERS)
+    memory = float(np.dot(model['findseed']['memory'], MEMORY_FEATURES(run_dims)))
+    for stage, features in STAGE_FEATURES.items():
+        if stage == 'findseed' or stage not in model:
+            continue
+        t = float(np.dot(model[stage]['time'], features(dims)))
+        if stage == 'bicluster':
+            # Run side by side like the FindSeed runs
+            compute += t * BICLUSTERS
+            runtime += t * ceil(BICLUSTERS / settings.MCBICLUST_SEED_WORKERS)
+            continue
+        compute += t
+        runtime += t
+        memory = max(memory, float(np.dot(model[stage]['memory'], MEMORY_FEATURES(dims))))
+    return {'compute': compute, 'runtime': runtime, 'memory': memory, 'complete': all(stage in model for stage in STAGE_FEATURES)}
+
+
+def estimate(a, seed_size, iterations, runs, geneset_size):
+    store_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user_id, a.id))
+    if not gemstore.exists(store_dir):
+        return None
+    genes, samples = gemstore.shape(store_dir)
+    return predict(get_model(), genes, samples, geneset_size, seed_size, iterations, runs)
+
+
+def budget(profile):
+    budgets = settings.MCBICLUST_COMPUTE_BUDGETS
+    return budgets.get(profile.user_type, budgets['normal'])
+
+
+def committed(profile, exclude=None):
+    # Worker seconds the user has used in the last day, plus the estimates of their queued analyses
+    since = timezone.now() - datetime.timedelta(days=1)
+    used = StageMetric.objects.filter(analysis__user=profile, date_recorded__gte=since).aggregate(total=Sum('wall_time'))['total'] or 0
+    for a in Analysis.objects.filter(user=profile, queued_at__isnull=False).exclude(id=getattr(exclude, 'id', None)).only('id', 'user_id', 'job'):
+        job = json.loads(a.job)
+        e = estimate(a, job['seed_size'], job['iterations'], job['num_runs'], len(job['geneset']))
+        if e is not None:
+            used += e['compute']
+    return used
+
+
+def admit(a, e):
+    # 'ok', 'confirm' or 'refuse', and why. Without an estimate the job is let through.
+    if e is None:
+        return 'ok', ""
+    limits = budget(a.user)
+    if e['memory'] > limits['memory']:
+        return 'refuse', "The analysis would need about {0:.1f} GB of memory, more than the {1:.1f} GB a worker has.".format(e['memory'] / 1024 ** 2, limits['memory'] / 1024 ** 2)
+    left = limits['daily'] - committed(a.user, exclude=a)
+    if e['compute'] > left:
+        return 'refuse', "The analysis would take about {0} of worker time, and {1} of your daily budget is left.".format(duration(e['compute']), duration(max(left, 0)))
+    if e['compute'] > limits['confirm']:
+        return 'confirm', "The analysis will take about {0} of worker time, please confirm.".format(duration(e['compute']))
+    return 'ok', ""
+
+
+def duration(seconds):
+    if seconds < 120:
+        return "{0:.0f} seconds".format(seconds)
+    if seconds < 7200:
+        return "{0:.0f} minutes".format(seconds / 60)
+    return "{0:.1f} hours".format(seconds / 3600)
@@ -0,0 +1,220 @@
+import numpy as np
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+# Number of genes processed per block by the batched engines, bounds the size of temporaries
+CHUNK_GENES = 4096
+
+
+def batch_corvecs(gem, seeds, gene_vecs, out=None, chunk=CHUNK_GENES):
+    # Correlation of every gene in gem (genes x samples) with each run's gene vector, taken over
+    # that run's seed samples. seeds holds 0-based sample indices, gene_vecs the matching
+    # reference profiles. All runs are done together with three matrix products per chunk.
+    n_genes, n_samples = gem.shape
+    num_runs = len(seeds)
+    if out is None:
+        out = np.empty((n_genes, num_runs))
+
+    # weights[:, r] holds run r's centred, unit norm gene vector on its seed samples,
+    # member[:, r] marks the seed samples of run r
+    weights = np.zeros((n_samples, num_runs))
+    member = np.zeros((n_samples, num_runs))
+    for r, (seed, vec) in enumerate(zip(seeds, gene_vecs)):
+        vec = np.asarray(vec, dtype=np.float64)
+        vec = vec - vec.mean()
+        weights[seed, r] = vec / np.sqrt(np.dot(vec, vec))
+        member[seed, r] = 1.0
+    seed_size = member.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for lo in range(0, n_genes, chunk):
+            block = np.asarray(gem[lo:lo + chunk], dtype=np.float64)
+            # Shifting a gene by a constant leaves its correlations unchanged but keeps the
+            # sum of squares below well conditioned
+            block = block - block.mean(axis=1, keepdims=True)
+            sums = block @ member
+            sum_sq = (block * block) @ member - sums * sums / seed_size
+            # Genes constant over a seed give NA, as cor does in R
+            sum_sq[sum_sq <= 0] = np.nan
+            out[lo:lo + chunk] = (block @ weights) / np.sqrt(sum_sq)
+
+    return out
+
+
+def corvecs_agree(x, y, rtol=1e-6, atol=1e-8):
+    # Check two correlation vectors (or matrices of them) are numerically the same, NAs included
+    return np.allclose(x, y, rtol=rtol, atol=atol, equal_nan=True)
+
+
+def cor_score(cross, sums, seed_size, out):
+    # mean(abs(cor)) between the genes over the seed samples, as CorScoreCalc in MCbiclust,
+    # from the seed's sum vector and cross-product matrix. out is a genes x genes work buffer.
+    np.outer(sums, sums, out=out)
+    out *= -1.0 / seed_size
+    out += cross
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sd = np.sqrt(np.diag(out).copy())
+        out /= sd[:, None]
+        out /= sd[None, :]
+    np.abs(out, out=out)
+    return out.mean()
+
+
+def top_genes(corvec, n):
+    # Rows of the n genes with the largest absolute average correlation, largest first and NAs
+    # last as order(abs(x), decreasing=TRUE) in MultiSampleSortPrep
+    return np.argsort(-np.abs(np.asarray(corvec, dtype=np.float64)), kind='stable')[:n]
+
+
+def best_seed(top_gem, seeds):
+    # Position in seeds (0-based sample indices) of the seed with the highest correlation score
+    # over the top genes, the seed MultiSampleSortPrep picks for a bicluster
+    scores = []
+    for seed in seeds:
+        x = np.asarray(top_gem[:, seed], dtype=np.float64)
+        x = x - x.mean(axis=1, keepdims=True)
+        work = np.empty((len(x), len(x)))
+        scores.append(cor_score(x @ x.T, x.sum(axis=1), len(seed), work))
+    # NA scores are passed over, as by which.max
+    return int(np.argmax(np.nan_to_num(scores, nan=-np.inf)))
+
+
+def random_proposals(rng, iterations, num_samples, seed_size):
+    # Position in the seed to replace and rank of the replacement among the samples outside the seed
+    for i in range(iterations):
+        yield rng.integers(seed_size), rng.integers(num_samples - seed_size)
+
+
+def find_seed(gem, seed_size, initial_seed, proposals, refresh=100):
+    # FindSeed hill climb over the samples (columns) of the gene set matrix gem: each iteration
+    # replaces one seed sample and keeps the swap if the correlation score goes up. The seed's
+    # sums and cross-products are kept, so a swap is a rank-one downdate and update instead of
+    # a new correlation matrix. They are rebuilt every refresh accepted swaps to stop rounding
+    # errors building up. Indices are 0-based.
+    gem = np.asarray(gem, dtype=np.float64)
+    # Centring each gene leaves correlations unchanged and keeps the cross-products small
+    gem = gem - gem.mean(axis=1, keepdims=True)
+    num_samples = gem.shape[1]
+    seed = np.array(initial_seed)
+    in_seed = np.zeros(num_samples, dtype=bool)
+    in_seed[seed] = True
+
+    sums = gem[:, seed].sum(axis=1)
+    cross = gem[:, seed] @ gem[:, seed].T
+    new_cross = np.empty_like(cross)
+    work = np.empty_like(cross)
+    score = cor_score(cross, sums, seed_size, work)
+
+    accepted = 0
+    for position, rank in proposals:
+        old = seed[position]
+        new = np.flatnonzero(~in_seed)[rank]
+        x_old = gem[:, old]
+        x_new = gem[:, new]
+        np.copyto(new_cross, cross)
+        new_cross -= np.outer(x_old, x_old)
+        new_cross += np.outer(x_new, x_new)
+        new_sums = sums - x_old + x_new
+        new_score = cor_score(new_cross, new_sums, seed_size, work)
+        # NaN scores (a gene constant over the seed) are never accepted
+        if new_score > score:
+            seed[position] = new
+            in_seed[old] = False
+            in_seed[new] = True
+            cross, new_cross = new_cross, cross
+            sums = new_sums
+            score = new_score
+            accepted += 1
+            if accepted % refresh == 0:
+                sums = gem[:, seed].sum(axis=1)
+                cross = gem[:, seed] @ gem[:, seed].T
+
+    return seed
+
+
+def run_correlations(cormat, chunk=CHUNK_GENES):
+    # abs(cor(cormat, use='complete.obs')) between the correlation vectors (columns) of a genes x
+    # runs matrix, over the genes with no NA in any run. The runs x runs cross-products are
+    # accumulated over blocks of genes, so no centred copy of the whole matrix is made.
+    n_genes, num_runs = cormat.shape
+    count = 0
+    sums = np.zeros(num_runs)
+    for lo in range(0, n_genes, chunk):
+        block = np.asarray(cormat[lo:lo + chunk], dtype=np.float64)
+        block = block[~np.isnan(block).any(axis=1)]
+        count += len(block)
+        sums += block.sum(axis=0)
+    mean = sums / count
+    cross = np.zeros((num_runs, num_runs))
+    for lo in range(0, n_genes, chunk):
+        block = np.asarray(cormat[lo:lo + chunk], dtype=np.float64)
+        block = block[~np.isnan(block).any(axis=1)] - mean
+        cross += block.T @ block
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sd = np.sqrt(np.diag(cross))
+        cor = cross / sd[:, None] / sd[None, :]
+    np.abs(cor, out=cor)
+    # Runs constant over the genes stay NA, as in R
+    diagonal = np.arange(num_runs)
+    cor[diagonal, diagonal] = np.where(sd > 0, 1.0, np.nan)
+    return cor
+
+
+def first_appearance(labels):
+    # Cluster labels renumbered from 0 in order of first appearance, the numbering cutree uses
+    values, first = np.unique(labels, return_index=True)
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(values))
+    return rank[np.searchsorted(values, labels)]
+
+
+def silhouette_widths(dist, labels, k):
+    # Silhouette width of every point, as cluster::silhouette: singletons and points as close to
+    # their nearest other cluster as to their own get 0
+    n = len(labels)
+    points = np.arange(n)
+    member = np.zeros((n, k))
+    member[points, labels] = 1.0
+    sizes = member.sum(axis=0)
+    totals = dist @ member
+    own = sizes[labels]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = totals[points, labels] / (own - 1)
+        mean = totals / sizes
+    mean[points, labels] = np.inf
+    b = mean.min(axis=1)
+    width = np.zeros(n)
+    ok = (own > 1) & (a != b)
+    width[ok] = (b[ok] - a[ok]) / np.maximum(a[ok], b[ok])
+    return width
+
+
+def cluster_runs(cor, max_clusters):
+    # Complete linkage clustering of the runs on the distance 1 - cor, as hclust, cut into 2 to
+    # max_clusters groups. The cut with the highest average silhouette width gives the groups, as
+    # SilhouetteClustGroups. Returns the linkage (for the heatmap dendrogram), the average width
+    # of each cut and the groups as a groups x runs boolean array.
+    dist = 1 - cor
+    num_runs = len(dist)
+    np.fill_diagonal(dist, 0)
+    ks = list(range(2, min(max_clusters, num_runs - 1) + 1))
+    if not ks:
+        raise ValueError("at least 3 runs are needed to cluster them")
+    linkage = hierarchy.linkage(squareform(dist, checks=False), method='complete')
+    cuts = hierarchy.cut_tree(linkage, n_clusters=ks)
+    labels = [first_appearance(cuts[:, j]) for j in range(len(ks))]
+    widths = np.array([silhouette_widths(dist, labels[j], k).mean() for j, k in enumerate(ks)])
+    best = int(np.argmax(widths))
+    groups = labels[best][None, :] == np.arange(ks[best])[:, None]
+    return {'linkage': linkage, 'widths': widths, 'groups': groups}
+
+
+def hclust_merge(linkage):
+    # merge matrix and leaf order of an R hclust object from a SciPy linkage. Singletons are
+    # negative 1-based run numbers and merged clusters the 1-based step that formed them.
+    n = len(linkage) + 1
+    merge = np.empty((n - 1, 2), dtype=np.int64)
+    for j in range(2):
+        node = linkage[:, j].astype(np.int64)
+        merge[:, j] = np.where(node < n, -(node + 1), node - n + 1)
+    return merge, hierarchy.leaves_list(linkage) + 1
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from mcbiclustweb import lookup
+
+# Binary copy of the preprocessed gene expression matrix: the values as a .npy file that
+# workers memory-map instead of parsing gem.csv, plus one name per line for genes and samples.
+MATRIX_FILE = 'gem.npy'
+GENES_FILE = 'genes.txt'
+SAMPLES_FILE = 'samples.txt'
+DIGEST_FILE = 'gem.sha256'
+# Hashed name indexes, built once here instead of searching the name lists on every lookup
+INDEX_FILE = 'names.json'
+
+
+def exists(store_dir):
+    return all(os.path.exists(os.path.join(store_dir, f)) for f in (MATRIX_FILE, GENES_FILE, SAMPLES_FILE))
+
+
+def write_names(path, names):
+    with open(path, 'w') as f:
+        for name in names:
+            f.write(name + '\n')
+
+
+def read_names(path):
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def write(store_dir, matrix, genes, samples, dtype=np.float64):
+    # The matrix is written through a memory map, so it can come in as any array-like
+    # (including another memory map) without a second full copy
+    gem = np.lib.format.open_memmap(os.path.join(store_dir, MATRIX_FILE), mode='w+', dtype=dtype, shape=(len(genes), len(samples)))
+    gem[:] = matrix
+    gem.flush()
+    del gem
+    write_names(os.path.join(store_dir, GENES_FILE), genes)
+    write_names(os.path.join(store_dir, SAMPLES_FILE), samples)
+    write_index(store_dir, genes, samples)
+    if os.path.exists(os.path.join(store_dir, DIGEST_FILE)):
+        os.remove(os.path.join(store_dir, DIGEST_FILE))
+
+
+class Writer:
+    # Builds a store one gene at a time, for when the number of genes is only known at the end.
+    # Rows go to a raw file first, the .npy header is written in front of them by close.
+    def __init__(self, store_dir, samples, dtype=np.float64):
+        self.store_dir = store_dir
+        self.samples = samples
+        self.dtype = np.dtype(dtype)
+        self.genes = []
+        self.raw_path = os.path.join(store_dir, MATRIX_FILE + '.raw')
+        self.raw = open(self.raw_path, 'wb')
+
+    def append(self, gene, values):
+        self.raw.write(np.asarray(values, dtype=self.dtype).tobytes())
+        self.genes.append(gene)
+
+    def close(self):
+        self.raw.close()
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (len(self.genes), len(self.samples))}
+        with open(os.path.join(self.store_dir, MATRIX_FILE), 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            with open(self.raw_path, 'rb') as raw:
+                shutil.copyfileobj(raw, f, 1 << 20)
+        os.remove(self.raw_path)
+        write_names(os.path.join(self.store_dir, GENES_FILE), self.genes)
+        write_names(os.path.join(self.store_dir, SAMPLES_FILE), self.samples)
+        write_index(self.store_dir, self.genes, self.samples)
+        if os.path.exists(os.path.join(self.store_dir, DIGEST_FILE)):
+            os.remove(os.path.join(self.store_dir, DIGEST_FILE))
+
+    def abort(self):
+        self.raw.close()
+        os.remove(self.raw_path)
+
+
+def link(store_dir, other_dir):
+    # Give other_dir the same store, hard linked so the matrix is on disk and in the page cache
+    # once, copied where the directories are on different file systems
+    for name in (MATRIX_FILE, GENES_FILE, SAMPLES_FILE, INDEX_FILE, DIGEST_FILE):
+        path = os.path.join(store_dir, name)
+        if not os.path.exists(path):
+            continue
+        try:
+            os.link(path, os.path.join(other_dir, name))
+        except OSError:
+            shutil.copyfile(path, os.path.join(other_dir, name))
+
+
+def write_index(store_dir, genes, samples):
+    path = os.path.join(store_dir, INDEX_FILE)
+    tmp = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'genes': lookup.build(genes), 'samples': lookup.build(samples)}, f)
+    os.replace(tmp, path)
+
+
+def load_index(store_dir):
+    # Gene and sample indexes, built for stores written before they were kept
+    path = os.path.join(store_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        write_index(store_dir, read_names(os.path.join(store_dir, GENES_FILE)), read_names(os.path.join(store_dir, SAMPLES_FILE)))
+    with open(path) as f:
+        index = json.load(f)
+    return index['genes'], index['samples']
+
+
+def shape(store_dir):
+    # Genes and samples of the matrix, from the .npy header without reading the names
+    return np.load(os.path.join(store_dir, MATRIX_FILE), mmap_mode='r').shape
+
+
+def load(store_dir):
+    # Read-only memory map, pages are shared between all worker processes on the node
+    gem = np.load(os.path.join(store_dir, MATRIX_FILE), mmap_mode='r')
+    genes = read_names(os.path.join(store_dir, GENES_FILE))
+    samples = read_names(os.path.join(store_dir, SAMPLES_FILE))
+    return gem, genes, samples
+
+
+def digest(store_dir):
+    # SHA-256 of the matrix and names, computed once and kept next to the store
+    path = os.path.join(store_dir, DIGEST_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read().strip()
+    h = hashlib.sha256()
+    for name in (MATRIX_FILE, GENES_FILE, SAMPLES_FILE):
+        with open(os.path.join(store_dir, name), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    with open(path, 'w') as f:
+        f.write(h.hexdigest())
+    return h.hexdigest()
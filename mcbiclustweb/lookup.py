@@ -0,0 +1,80 @@
+import functools
+
+# Hashed indexes of gene and sample names. Names are matched exactly first, then optionally
+# ignoring case, then optionally through a table of gene aliases (previous symbols, synonyms).
+
+
+def build(names):
+    # Row of each name (the first, if repeated), and the rows of each case-folded name
+    exact = {}
+    folded = {}
+    for i, name in enumerate(names):
+        exact.setdefault(name, i)
+        folded.setdefault(name.casefold(), []).append(i)
+    return {'exact': exact, 'folded': folded}
+
+
+def match(index, name, ignore_case=False):
+    row = index['exact'].get(name)
+    if row is None and ignore_case:
+        rows = index['folded'].get(name.casefold(), [])
+        # Names that only differ in case are ambiguous, they have to match exactly
+        if len(rows) == 1:
+            row = rows[0]
+    return row
+
+
+def resolve(index, names, ignore_case=False, aliases=None):
+    # Rows of all the names in one pass, None where not found, and the names not found
+    rows = []
+    missing = []
+    for name in names:
+        row = match(index, name, ignore_case)
+        if row is None and aliases is not None:
+            alias_rows = aliases['exact'].get(name, [])
+            if not alias_rows and ignore_case:
+                alias_rows = aliases['folded'].get(name.casefold(), [])
+            for i in alias_rows:
+                row = match(index, aliases['symbols'][i], ignore_case)
+                if row is not None:
+                    break
+        rows.append(row)
+        if row is None:
+            missing.append(name)
+    return rows, missing
+
+
+@functools.lru_cache(maxsize=4)
+def aliases(path):
+    # Tab separated alias and official symbol per line, indexed like the names of a GEM.
+    # Kept per process, the file does not change while workers run.
+    if not path:
+        return None
+    names = []
+    symbols = []
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2 and fields[0] and fields[1]:
+                names.append(fields[0])
+                symbols.append(fields[1])
+    index = build(names)
+    # An alias can stand for several symbols, all are tried in file order
+    index['exact'] = {}
+    for i, name in enumerate(names):
+        index['exact'].setdefault(name, []).append(i)
+    index['symbols'] = symbols
+    return index
+
+
+def missing_message(prefix, missing, max_length):
+    # As many of the missing names as fit in max_length, then how many more there are
+    message = "{0}: {1}".format(prefix, ", ".join(missing))
+    if len(message) <= max_length:
+        return message
+    shown = []
+    for name in missing:
+        if len("{0}: {1} and {2} more".format(prefix, ", ".join(shown + [name]), len(missing) - len(shown) - 1)) > max_length:
+            break
+        shown.append(name)
+    return "{0}: {1} and {2} more".format(prefix, ", ".join(shown), len(missing) - len(shown))
@@ -0,0 +1,21 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from mcbiclustweb import api
+from mcbiclustweb.models import Profile
+
+
+class Command(BaseCommand):
+    help = "Create a JSON API token for a user and print its key, which is not stored and cannot be shown again"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--name', default='', help="What the token is used for")
+
+    def handle(self, *args, **options):
+        try:
+            profile = Profile.objects.get(user=User.objects.get(username=options['username']))
+        except (User.DoesNotExist, Profile.DoesNotExist):
+            raise CommandError("no user {0}".format(options['username']))
+        token, key = api.create_token(profile, options['name'])
+        self.stdout.write(key)
@@ -0,0 +1,127 @@
+import contextlib
+import json
+import os
+import platform
+import tempfile
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+
+from mcbiclustweb import synthetic
+from mcbiclustweb.models import Profile, Analysis, StageMetric, user_directory_path
+from mcbiclustweb.tasks import preprocess, runFindSeed
+
+# Settings that change which code the stages run, recorded with the results
+ENGINE_SETTINGS = ['MCBICLUST_NATIVE_PARSER', 'MCBICLUST_GEM_DTYPE', 'MCBICLUST_FINDSEED_ENGINE', 'MCBICLUST_FINDSEED_CHECK_RUNS',
+                   'MCBICLUST_CVEVAL_ENGINE', 'MCBICLUST_CVEVAL_CHECK_RUNS', 'MCBICLUST_CLUSTER_ENGINE', 'MCBICLUST_LOW_MEMORY']
+
+METRIC_FIELDS = ['wall_time', 'cpu_time', 'peak_rss']
+
+
+class Command(BaseCommand):
+    help = ("Time preprocess and the runFindSeed stages on synthetic series matrices, without the broker, and print the results as JSON. "
+            "Each repeat runs in a database transaction that is rolled back, so the benchmark user, analysis and stage metrics are never committed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--genes', type=int, default=5000)
+        parser.add_argument('--samples', type=int, default=100)
+        parser.add_argument('--biclusters', type=int, default=2)
+        parser.add_argument('--bicluster-genes', type=int, default=100)
+        parser.add_argument('--characteristics', type=int, default=3)
+        parser.add_argument('--geneset-size', type=int, default=50, help="Genes of the first planted bicluster used as gene set")
+        parser.add_argument('--seed-size', type=int, default=10)
+        parser.add_argument('--iterations', type=int, default=500)
+        parser.add_argument('--runs', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=1)
+        parser.add_argument('--random-seed', type=int, default=0)
+        parser.add_argument('--low-memory', action='store_true', help="Run with MCBICLUST_LOW_MEMORY, to compare the peak RSS of each stage")
+        parser.add_argument('--label', default='', help="Stored with the results, e.g. the version benchmarked")
+        parser.add_argument('--output', help="JSON file to write, instead of standard output")
+
+    def handle(self, *args, **options):
+        if options['geneset_size'] > options['bicluster_genes']:
+            raise CommandError("--geneset-size cannot be larger than --bicluster-genes")
+
+        low_memory = override_settings(MCBICLUST_LOW_MEMORY=True) if options['low_memory'] else contextlib.nullcontext()
+        with low_memory:
+            results = {
+                'label': options['label'],
+                'parameters': {k: options[k] for k in ['genes', 'samples', 'biclusters', 'bicluster_genes', 'characteristics', 'geneset_size',
+                                                       'seed_size', 'iterations', 'runs', 'repeat', 'random_seed']},
+                'settings': {k: getattr(settings, k, None) for k in ENGINE_SETTINGS},
+                'platform': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+                'repeats': [],
+            }
+            for i in range(options['repeat']):
+                results['repeats'].append(self.run_once(options, options['random_seed'] + i))
+                self.stderr.write("Repeat {0} of {1} done".format(i + 1, options['repeat']))
+
+        stages = {}
+        peaks = {}
+        for repeat in results['repeats']:
+            for stage, metrics in repeat['stages'].items():
+                stages.setdefault(stage, []).append(metrics['wall_time'])
+                peaks[stage] = max(peaks.get(stage, 0), metrics['peak_rss'])
+        results['summary'] = {stage: {'min': min(times), 'median': float(np.median(times)), 'max': max(times), 'peak_rss': peaks[stage]}
+                              for stage, times in stages.items()}
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_once(self, options, random_seed):
+        # Each repeat runs in a fresh MEDIA_ROOT, so nothing comes from the stage cache, and
+        # with the FindSeed runs and fork plots in this process. Its rows are rolled back, the
+        # site never lists the benchmark analysis and the cost model is not fitted on it.
+        with transaction.atomic():
+            try:
+                return self.run_analysis(options, random_seed)
+            finally:
+                transaction.set_rollback(True)
+
+    def run_analysis(self, options, random_seed):
+        user = User.objects.create(username='benchmark-' + uuid.uuid4().hex[:20])
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root, MCBICLUST_FINDSEED_FANOUT=False, MCBICLUST_BICLUSTER_FANOUT=False, MCBICLUST_FORK_PLOTS='lazy'):
+            a = Analysis.objects.create(name='benchmark', description='synthetic series matrix', user=Profile.objects.get(user=user), status="1. Preprocessing")
+            a.gem.name = user_directory_path(a, 'series_matrix.txt')
+            a.save(update_fields=['gem'])
+            path = os.path.join(media_root, a.gem.name)
+            os.makedirs(os.path.dirname(path))
+
+            start = time.perf_counter()
+            planted = synthetic.write_series_matrix(path, options['genes'], options['samples'], options['biclusters'], options['bicluster_genes'],
+                                                    characteristics=options['characteristics'], seed=random_seed)
+            totals = {'generate': time.perf_counter() - start}
+
+            start = time.perf_counter()
+            result = preprocess(a.id)
+            totals['preprocess'] = time.perf_counter() - start
+            if result != "success":
+                raise CommandError("preprocess failed: {0}".format(result))
+
+            geneset = planted[0]['genes'][:options['geneset_size']]
+            start = time.perf_counter()
+            result = runFindSeed(a.id, options['seed_size'], "", geneset, options['iterations'], options['runs'])
+            totals['runFindSeed'] = time.perf_counter() - start
+            a.refresh_from_db()
+
+            stages = {}
+            for m in StageMetric.objects.filter(analysis=a).order_by('id').values('stage', *METRIC_FIELDS):
+                # FindSeed runs and biclusters are recorded one row each, they are added up
+                s = stages.setdefault(m['stage'], {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss': 0})
+                s['count'] += 1
+                s['wall_time'] += m['wall_time']
+                s['cpu_time'] += m['cpu_time']
+                s['peak_rss'] = max(s['peak_rss'], m['peak_rss'])
+
+            return {'random_seed': random_seed, 'status': a.status, 'result': result, 'totals': totals, 'stages': stages}
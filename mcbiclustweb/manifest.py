@@ -0,0 +1,42 @@
+import hashlib
+import os
+
+from mcbiclustweb.models import Artifact
+
+# The artifacts of an analysis, so pages are rendered from the database instead of listing
+# the analysis directory
+
+# Kinds produced by preprocess, kept when the analysis is restarted
+PREPROCESS_KINDS = ['characteristics']
+
+
+def fork_plot_path(bicluster, characteristic):
+    return os.path.join(str(bicluster), 'forkplot_%s.png' % characteristic.replace(".", "_"))
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def record(analysis, store_dir, path, kind, bicluster=None, characteristic=''):
+    # Enter a file that has just been written
+    full_path = os.path.join(store_dir, path)
+    Artifact.objects.update_or_create(analysis=analysis, path=path, defaults={
+        'kind': kind, 'bicluster': bicluster, 'characteristic': characteristic,
+        'size': os.path.getsize(full_path), 'checksum': file_digest(full_path)})
+
+
+def expect(analysis, kind, entries):
+    # Enter files that will be rendered later, entries are (path, bicluster, characteristic).
+    # Files already entered, by an earlier delivery of the task, are kept as they are.
+    Artifact.objects.bulk_create([Artifact(analysis=analysis, kind=kind, path=path, bicluster=bicluster, characteristic=characteristic)
+                                  for path, bicluster, characteristic in entries], ignore_conflicts=True)
+
+
+def clear(analysis):
+    # Forget the results of a previous run of the analysis
+    Artifact.objects.filter(analysis=analysis).exclude(kind__in=PREPROCESS_KINDS).delete()
@@ -0,0 +1,44 @@
+import resource
+import time
+
+from mcbiclustweb.models import StageMetric
+
+
+def reset_peak_rss():
+    # Linux resets the process's peak RSS (VmHWM) when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    # Peak RSS in KB since the last reset, or over the life of the process where it cannot be reset
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Recorder:
+    # Records the stages of a task one after another: each lap stores the wall time, CPU time
+    # and peak RSS since the previous lap, with the dimensions of the input
+    def __init__(self, analysis, **dims):
+        self.analysis = analysis
+        self.dims = dims
+        self.start()
+
+    def start(self):
+        reset_peak_rss()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def lap(self, stage, **dims):
+        StageMetric.objects.create(analysis=self.analysis, stage=stage, wall_time=time.perf_counter() - self.wall,
+                                   cpu_time=time.process_time() - self.cpu, peak_rss=peak_rss(), **dict(self.dims, **dims))
+        self.start()
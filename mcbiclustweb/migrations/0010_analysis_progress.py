@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+def set_stage(apps, schema_editor):
+    Analysis = apps.get_model('mcbiclustweb', 'Analysis')
+    for a in Analysis.objects.only('id', 'status'):
+        try:
+            stage = int(a.status.split('.')[0])
+        except ValueError:
+            continue
+        Analysis.objects.filter(id=a.id).update(stage=stage)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcbiclustweb', '0009_auto_20180422_1618'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='progress_done',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='progress_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='stage',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.RunPython(set_stage, migrations.RunPython.noop),
+    ]
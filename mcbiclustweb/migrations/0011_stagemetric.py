@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcbiclustweb', '0010_analysis_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StageMetric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=50)),
+                ('wall_time', models.FloatField()),
+                ('cpu_time', models.FloatField()),
+                ('peak_rss', models.BigIntegerField()),
+                ('genes', models.IntegerField(null=True)),
+                ('samples', models.IntegerField(null=True)),
+                ('runs', models.IntegerField(null=True)),
+                ('seed_size', models.IntegerField(null=True)),
+                ('iterations', models.IntegerField(null=True)),
+                ('date_recorded', models.DateTimeField(auto_now_add=True)),
+                ('analysis', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='mcbiclustweb.analysis')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcbiclustweb', '0011_stagemetric'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['user', 'id'], name='analysis_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['user', 'stage', 'id'], name='analysis_user_stage_id_idx'),
+        ),
+    ]
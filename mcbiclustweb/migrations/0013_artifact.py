@@ -0,0 +1,82 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import hashlib
+import json
+import os
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def record_artifacts(apps, schema_editor):
+    # One last scan of the directories of existing analyses, the pages read the manifest from now on
+    Analysis = apps.get_model('mcbiclustweb', 'Analysis')
+    Artifact = apps.get_model('mcbiclustweb', 'Artifact')
+    for a in Analysis.objects.only('id', 'gem'):
+        store_dir = os.path.join(settings.MEDIA_ROOT, *a.gem.name.split("/")[:-1])
+        if not a.gem.name or not os.path.isdir(store_dir):
+            continue
+        entries = []
+        for name in sorted(os.listdir(store_dir)):
+            if name == 'characteristics.csv':
+                entries.append((name, 'characteristics', None, ''))
+            elif name == 'cor_heatmap.png':
+                entries.append((name, 'heatmap', None, ''))
+            elif name.startswith('sil_clust') and name.endswith('.png'):
+                entries.append((name, 'silhouette', None, ''))
+            elif name == 'cvplot.png':
+                entries.append((name, 'cvplot', None, ''))
+            elif name == 'fork_data.csv':
+                entries.append((name, 'forkdata', None, ''))
+        # Characteristic column names were kept in forkplots.json, older analyses only have the file names
+        columns = {}
+        if os.path.exists(os.path.join(store_dir, 'forkplots.json')):
+            with open(os.path.join(store_dir, 'forkplots.json')) as f:
+                columns = json.load(f)['characteristics']
+        for name in sorted((n for n in os.listdir(store_dir) if n.isdigit()), key=int):
+            if not os.path.isdir(os.path.join(store_dir, name)):
+                continue
+            for plot in sorted(os.listdir(os.path.join(store_dir, name))):
+                if plot.startswith('forkplot_') and plot.endswith('.png'):
+                    char = plot[9:-4]
+                    entries.append((os.path.join(name, plot), 'forkplot', int(name), columns.get(char, char)))
+        Artifact.objects.bulk_create([
+            Artifact(analysis=a, kind=kind, path=path, bicluster=bicluster, characteristic=characteristic,
+                     size=os.path.getsize(os.path.join(store_dir, path)), checksum=file_digest(os.path.join(store_dir, path)))
+            for path, kind, bicluster, characteristic in entries])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcbiclustweb', '0012_analysis_index_pagination'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Artifact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20)),
+                ('path', models.CharField(max_length=300)),
+                ('bicluster', models.IntegerField(null=True)),
+                ('characteristic', models.CharField(blank=True, max_length=200)),
+                ('size', models.BigIntegerField(null=True)),
+                ('checksum', models.CharField(blank=True, max_length=64)),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mcbiclustweb.analysis')),
+            ],
+            options={
+                'ordering': ['id'],
+                'unique_together': {('analysis', 'path')},
+            },
+        ),
+        migrations.RunPython(record_artifacts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcbiclustweb', '0013_artifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='dispatched_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='job',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='queued_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='last_dispatched',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['queued_at'], name='analysis_queued_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysis',
+            index=models.Index(fields=['dispatched_at'], name='analysis_dispatched_at_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcbiclustweb', '0014_analysis_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analysis',
+            name='task_ids',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mcbiclustweb', '0015_analysis_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysis',
+            name='sweep',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='combinations', to='mcbiclustweb.analysis'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -6,6 +7,8 @@ from django.dispatch import receiver
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     user_type = models.CharField(max_length=100, default="normal")
+    # When an analysis of this user was last started from the queue, users are served in turn
+    last_dispatched = models.DateTimeField(null=True)
 
     @receiver(post_save, sender=User)
     def create_user_profile(sender, instance, created, **kwargs):
@@ -22,4 +25,85 @@ class Analysis(models.Model):
     char_ok = models.BooleanField(default=True)
     user = models.ForeignKey(Profile, on_delete=models.CASCADE)
     status = models.CharField(max_length=200)
-    date_started = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    # Stage number at the start of status, and progress through the runs of the current stage
+    stage = models.IntegerField(default=1)
+    progress_done = models.IntegerField(default=0)
+    progress_total = models.IntegerField(default=0)
+    date_started = models.DateTimeField(auto_now_add=True)
+    # Set while the analysis waits in the queue, with its parameters as JSON, and while it
+    # holds one of the running slots once started from the queue
+    queued_at = models.DateTimeField(null=True)
+    dispatched_at = models.DateTimeField(null=True)
+    job = models.TextField(blank=True)
+    # Incremented on every restart or cancellation, with the ids of the current run's tasks
+    generation = models.IntegerField(default=0)
+    task_ids = models.TextField(blank=True)
+    # Analysis a parameter sweep combination was created from, combinations outlive it
+    sweep = models.ForeignKey('self', null=True, blank=True, related_name='combinations', on_delete=models.SET_NULL)
+
+    class Meta:
+        # The index page lists a user's analyses in id order, a page at a time, optionally by stage
+        indexes = [
+            models.Index(fields=['user', 'id'], name='analysis_user_id_idx'),
+            models.Index(fields=['user', 'stage', 'id'], name='analysis_user_stage_id_idx'),
+            models.Index(fields=['queued_at'], name='analysis_queued_at_idx'),
+            models.Index(fields=['dispatched_at'], name='analysis_dispatched_at_idx'),
+        ]
+
+    def set_status(self, status):
+        self.status = status
+        self.stage = int(status.split('.')[0])
+        self.save(update_fields=['status', 'stage'])
+        if self.stage == 12 or self.stage < 0:
+            # A finished or failed analysis gives its slot to the next one in the queue
+            if Analysis.objects.filter(id=self.id, dispatched_at__isnull=False).update(dispatched_at=None):
+                from mcbiclustweb.tasks import dispatchAnalyses
+                dispatchAnalyses.delay()
+
+    def start_progress(self, total):
+        self.progress_done = 0
+        self.progress_total = total
+        self.save(update_fields=['progress_done', 'progress_total'])
+
+    def advance_progress(self):
+        # Atomic, runs finishing on different workers each add one
+        Analysis.objects.filter(id=self.id).update(progress_done=F('progress_done') + 1)
+
+class StageMetric(models.Model):
+    # Resources used by one stage of an analysis task. Kept when the analysis is deleted,
+    # they are what the worker fleet is sized from.
+    analysis = models.ForeignKey(Analysis, null=True, on_delete=models.SET_NULL)
+    stage = models.CharField(max_length=50)
+    wall_time = models.FloatField()
+    cpu_time = models.FloatField()
+    # Peak resident set size of the worker process during the stage, in KB
+    peak_rss = models.BigIntegerField()
+    genes = models.IntegerField(null=True)
+    samples = models.IntegerField(null=True)
+    runs = models.IntegerField(null=True)
+    seed_size = models.IntegerField(null=True)
+    iterations = models.IntegerField(null=True)
+    date_recorded = models.DateTimeField(auto_now_add=True)
+
+class Artifact(models.Model):
+    # A file an analysis produced, path relative to the analysis directory. Fork plots are
+    # entered when their data is written and get a size and checksum once rendered.
+    analysis = models.ForeignKey(Analysis, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20)
+    path = models.CharField(max_length=300)
+    bicluster = models.IntegerField(null=True)
+    characteristic = models.CharField(max_length=200, blank=True)
+    size = models.BigIntegerField(null=True)
+    checksum = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        unique_together = [('analysis', 'path')]
+        ordering = ['id']
+
+class ApiToken(models.Model):
+    # Token of the JSON API, only its SHA-256 is kept
+    user = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    name = models.CharField(max_length=100, blank=True)
+    key_hash = models.CharField(max_length=64, unique=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(null=True)
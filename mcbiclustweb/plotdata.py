@@ -0,0 +1,40 @@
+import json
+import os
+import numpy as np
+
+# Compact data the analysis page draws the CV and fork plots from in the browser: an index
+# with the gene set rows and characteristic levels, and one file per bicluster with its
+# averaged correlation vector, sample order, PC1 values and characteristic codes.
+
+PLOT_DIR = 'plots'
+INDEX_FILE = 'index.json'
+DIGITS = 4
+
+
+def bicluster_file(bicluster):
+    return 'bic%d.json' % bicluster
+
+
+def values(x):
+    # Rounded floats, with NaN as null since JSON has no NaN
+    x = np.round(np.asarray(x, dtype=np.float64).ravel(), DIGITS)
+    return [None if np.isnan(v) else float(v) for v in x]
+
+
+def write(store_dir, name, data):
+    # Returns the path of the file relative to the analysis directory
+    os.makedirs(os.path.join(store_dir, PLOT_DIR), exist_ok=True)
+    path = os.path.join(store_dir, PLOT_DIR, name)
+    tmp = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+    return os.path.join(PLOT_DIR, name)
+
+
+def update(store_dir, name, data):
+    # Add fields to a file written by an earlier stage
+    with open(os.path.join(store_dir, PLOT_DIR, name)) as f:
+        current = json.load(f)
+    current.update(data)
+    return write(store_dir, name, current)
@@ -0,0 +1,52 @@
+import os
+import rpy2.robjects as ro
+from rpy2.robjects.packages import importr
+import rpy2.rinterface as ri
+
+# R libraries used by the tasks, with the keyword arguments they are imported with
+LIBRARIES = {
+    'base': {},
+    'grDevices': {},
+    'GEOquery': {},
+    'MCbiclust': {},
+    'gplots': {},
+    'ggplot2': {},
+    'dplyr': {'on_conflict': "warn"},
+    'gtools': {},
+    'stringr': {},
+}
+
+_libraries = {}
+
+# Set once R stopped answering, the worker process is replaced before its next task
+unhealthy = False
+
+
+def load():
+    # Start R and import every library. Worker processes call this once when they start,
+    # anything else loads lazily on first use.
+    ri.initr()
+    for name in LIBRARIES:
+        library(name)
+
+
+def library(name):
+    if name not in _libraries:
+        ri.initr()
+        _libraries[name] = importr(name, **LIBRARIES.get(name, {}))
+    return _libraries[name]
+
+
+def healthy():
+    # Free what the last task left behind and make sure R still answers
+    try:
+        ro.r.gc()
+        return ro.r('1L')[0] == 1
+    except Exception:
+        return False
+
+
+def recycle():
+    # An embedded R session cannot be restarted, so the worker process exits and the pool
+    # replaces it with a fresh one
+    os._exit(1)
@@ -0,0 +1,91 @@
+import json
+from collections import Counter, OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from mcbiclustweb.models import Profile, Analysis
+
+# Queue of started analyses. At most MCBICLUST_MAX_RUNNING_ANALYSES run at once, and at most
+# MCBICLUST_MAX_RUNNING_PER_USER of one user, free slots go to the users with queued analyses
+# in turn, starting with the one served longest ago.
+
+QUEUED_STATUS = "3. Queued for analysis"
+STARTED_STATUS = "3. Started analysis"
+
+
+def failed_status(stage, reason=None):
+    # Failed status of an analysis stopped at stage, numbered like the failures of that stage
+    # so the analysis page shows the figures it got to
+    if stage >= 8:
+        number, error = -5, "error extending distinct biclusters"
+    elif stage == 7:
+        number, error = -4, "error finding distinct biclusters"
+    elif stage >= 4:
+        number, error = -3, "error calculating correlation vectors"
+    else:
+        number, error = -1, "error finding seeds"
+    return "{0}. Failed: {1}, please try to restart the analysis".format(number, reason or error)
+
+
+def enqueue(a, job):
+    a.job = json.dumps(job)
+    a.queued_at = timezone.now()
+    a.dispatched_at = None
+    a.save(update_fields=['job', 'queued_at', 'dispatched_at'])
+    a.set_status(QUEUED_STATUS)
+
+
+def claim():
+    # Take the analyses to start now off the queue and return their ids, parameters and generations. The
+    # queued rows stay locked until the slots are taken, so concurrent calls do not overfill them.
+    now = timezone.now()
+    claimed = []
+    with transaction.atomic():
+        # Slots held past the timeout are taken back, a new generation stops any task still running
+        stale = Analysis.objects.filter(dispatched_at__lt=now - timedelta(seconds=settings.MCBICLUST_DISPATCH_TIMEOUT))
+        for a in stale.only('id', 'stage'):
+            status = failed_status(a.stage, "the analysis did not finish in time")
+            Analysis.objects.filter(id=a.id).update(dispatched_at=None, generation=F('generation') + 1, status=status, stage=int(status.split('.')[0]))
+        queued = list(Analysis.objects.select_for_update().filter(queued_at__isnull=False).order_by('queued_at', 'id').only('id', 'user_id', 'queued_at', 'job', 'generation'))
+        if not queued:
+            return []
+        running = Counter(Analysis.objects.filter(dispatched_at__isnull=False).values_list('user_id', flat=True))
+        slots = settings.MCBICLUST_MAX_RUNNING_ANALYSES - sum(running.values())
+
+        by_user = OrderedDict()
+        for a in queued:
+            by_user.setdefault(a.user_id, []).append(a)
+        last = dict(Profile.objects.filter(id__in=list(by_user)).values_list('id', 'last_dispatched'))
+        users = sorted(by_user, key=lambda u: (last[u] is not None, last[u] or now, by_user[u][0].queued_at))
+
+        # One analysis per user per round, until the slots or the eligible users run out
+        while slots > 0 and users:
+            for u in list(users):
+                if slots == 0:
+                    break
+                if running[u] >= settings.MCBICLUST_MAX_RUNNING_PER_USER or not by_user[u]:
+                    users.remove(u)
+                    continue
+                claimed.append(by_user[u].pop(0))
+                running[u] += 1
+                slots -= 1
+
+        for a in claimed:
+            Analysis.objects.filter(id=a.id).update(queued_at=None, dispatched_at=now, status=STARTED_STATUS, stage=3)
+        Profile.objects.filter(id__in={a.user_id for a in claimed}).update(last_dispatched=now)
+    return [(a.id, json.loads(a.job), a.generation) for a in claimed]
+
+
+def queue_position(a):
+    # Place in the queue under turn-taking: the user's own earlier analyses, plus up to as
+    # many (and one more) of every other user's
+    if a.queued_at is None:
+        return None
+    queued = Analysis.objects.filter(queued_at__isnull=False)
+    ahead = queued.filter(user_id=a.user_id, queued_at__lt=a.queued_at).count()
+    others = Counter(queued.exclude(user_id=a.user_id).values_list('user_id', flat=True))
+    return ahead + sum(min(n, ahead + 1) for n in others.values()) + 1
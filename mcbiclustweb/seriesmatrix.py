@@ -0,0 +1,113 @@
+import re
+import numpy as np
+
+from mcbiclustweb import gemstore
+from mcbiclustweb.characteristics import make_unique
+
+# Streaming reader for GEO series matrix files. The !Sample_ header lines are kept (they are
+# small), the expression table is read one gene at a time and written straight to the binary
+# GEM store, so memory stays bounded whatever the size of the file.
+
+NA_VALUES = {'', 'NA', 'null', 'NULL', 'NaN', 'nan'}
+
+
+class SeriesMatrixError(ValueError):
+    pass
+
+
+def unquote(field):
+    if len(field) >= 2 and field[0] == '"' and field[-1] == '"':
+        return field[1:-1]
+    return field
+
+
+def split_line(line):
+    return [unquote(field) for field in line.rstrip('\r\n').split('\t')]
+
+
+def parse_values(fields):
+    try:
+        return np.array(fields, dtype=np.float64)
+    except ValueError:
+        pass
+    try:
+        return np.array([np.nan if unquote(x) in NA_VALUES else float(unquote(x)) for x in fields])
+    except ValueError:
+        raise SeriesMatrixError("non-numeric value in expression table")
+
+
+def parse(path, store_dir, dtype=np.float64):
+    # Write the expression table to the GEM store, dropping genes with NAs or summing to 0
+    # like the GEOquery path does, and return the sample names and !Sample_ header fields.
+    # Files that are not UTF-8, often Latin-1 headers such as "µg" in characteristics, are
+    # read again as Latin-1, which decodes any byte.
+    try:
+        return parse_encoded(path, store_dir, dtype, 'utf-8')
+    except UnicodeDecodeError:
+        return parse_encoded(path, store_dir, dtype, 'latin-1')
+
+
+def parse_encoded(path, store_dir, dtype, encoding):
+    sample_fields = []
+    with open(path, encoding=encoding) as f:
+        for line in f:
+            if line.startswith('!Sample_'):
+                fields = split_line(line)
+                sample_fields.append((fields[0][len('!Sample_'):], fields[1:]))
+            elif line.startswith('!series_matrix_table_begin'):
+                break
+        else:
+            raise SeriesMatrixError("no series_matrix_table block")
+
+        samples = split_line(next(f, ''))[1:]
+        if not samples:
+            raise SeriesMatrixError("no samples in expression table header")
+        for name, values in sample_fields:
+            if len(values) != len(samples):
+                raise SeriesMatrixError("!Sample_{0} does not have one value per sample".format(name))
+
+        writer = gemstore.Writer(store_dir, samples, dtype)
+        try:
+            for line in f:
+                if line.startswith('!series_matrix_table_end'):
+                    break
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) != len(samples) + 1:
+                    raise SeriesMatrixError("expression table row with wrong number of values")
+                values = parse_values(fields[1:])
+                if np.isnan(values).any() or values.sum() == 0:
+                    continue
+                writer.append(unquote(fields[0]), values)
+            else:
+                raise SeriesMatrixError("expression table is not terminated")
+            if not writer.genes:
+                raise SeriesMatrixError("no genes without NAs")
+        except:
+            writer.abort()
+            raise
+        writer.close()
+
+    return samples, sample_fields
+
+
+def sample_table(sample_fields):
+    # The columns of GEOquery's phenoData: the !Sample_ fields with names made unique, then
+    # one "key:chN" column per key of the "key: value" characteristics, sorted by key
+    names = make_unique([name for name, values in sample_fields])
+    columns = [values for name, values in sample_fields]
+    num_samples = len(columns[0]) if columns else 0
+    parsed = {}
+    for name, values in zip(names, columns):
+        m = re.match(r'characteristics_(ch\d+)', name)
+        if m is None:
+            continue
+        for i, value in enumerate(values):
+            if ':' not in value:
+                continue
+            k, v = value.split(':', 1)
+            col = parsed.setdefault(k.strip() + ':' + m.group(1), [None] * num_samples)
+            col[i] = v.strip() if col[i] is None else col[i] + ';' + v.strip()
+    for k in sorted(parsed):
+        names.append(k)
+        columns.append(['' if v is None else v for v in parsed[k]])
+    return names, columns
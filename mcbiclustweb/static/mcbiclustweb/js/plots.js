@@ -0,0 +1,139 @@
+// CV and fork plots drawn on a canvas from the plot data files the analysis tasks write
+var MCbiclustPlots = (function() {
+    var PALETTE = ["#F8766D", "#00BFC4", "#7CAE00", "#C77CFF", "#CD9600", "#00A9FF", "#00BE67", "#FF61CC", "#B79F00", "#619CFF"];
+    var MISSING = "#BBBBBB";
+
+    function range(values) {
+        var lo = Infinity, hi = -Infinity;
+        for (var i = 0; i < values.length; i++) {
+            if (values[i] === null)
+                continue;
+            lo = Math.min(lo, values[i]);
+            hi = Math.max(hi, values[i]);
+        }
+        if (lo == hi) {
+            lo -= 1;
+            hi += 1;
+        }
+        return [lo, hi];
+    }
+
+    function ticks(lo, hi) {
+        var out = [];
+        for (var i = 0; i <= 4; i++)
+            out.push(lo + (hi - lo) * i / 4);
+        return out;
+    }
+
+    function label(v) {
+        return Math.abs(v) >= 100 ? v.toFixed(0) : v.toPrecision(2);
+    }
+
+    // Points are drawn in the order of "layers", so highlighted points can go on top
+    function scatter(canvas, xs, ys, colours, opts) {
+        var ctx = canvas.getContext("2d");
+        var legendWidth = opts.legend ? 150 : 0;
+        var left = 60, right = 20 + legendWidth, top = 20, bottom = 50;
+        var width = canvas.width - left - right, height = canvas.height - top - bottom;
+        var xr = range(xs), yr = range(ys);
+        function px(x) { return left + (x - xr[0]) / (xr[1] - xr[0]) * width; }
+        function py(y) { return top + height - (y - yr[0]) / (yr[1] - yr[0]) * height; }
+
+        ctx.fillStyle = "#FFFFFF";
+        ctx.fillRect(0, 0, canvas.width, canvas.height);
+        ctx.strokeStyle = "#333333";
+        ctx.strokeRect(left, top, width, height);
+        ctx.fillStyle = "#333333";
+        ctx.font = "12px sans-serif";
+        ctx.textAlign = "center";
+        ticks(xr[0], xr[1]).forEach(function(t) {
+            ctx.fillText(label(t), px(t), top + height + 16);
+        });
+        ctx.fillText(opts.xlabel, left + width / 2, top + height + 38);
+        ctx.textAlign = "right";
+        ticks(yr[0], yr[1]).forEach(function(t) {
+            ctx.fillText(label(t), left - 6, py(t) + 4);
+        });
+        ctx.save();
+        ctx.translate(14, top + height / 2);
+        ctx.rotate(-Math.PI / 2);
+        ctx.textAlign = "center";
+        ctx.fillText(opts.ylabel, 0, 0);
+        ctx.restore();
+
+        var order = opts.layers || [xs.map(function(x, i) { return i; })];
+        order.forEach(function(layer) {
+            layer.forEach(function(i) {
+                if (xs[i] === null || ys[i] === null)
+                    return;
+                ctx.fillStyle = colours[i];
+                ctx.beginPath();
+                ctx.arc(px(xs[i]), py(ys[i]), opts.radius || 2, 0, 2 * Math.PI);
+                ctx.fill();
+            });
+        });
+
+        if (opts.legend) {
+            ctx.textAlign = "left";
+            ctx.fillStyle = "#333333";
+            ctx.fillText(opts.legendTitle || "", canvas.width - legendWidth, top + 10);
+            opts.legend.forEach(function(entry, j) {
+                ctx.fillStyle = entry[1];
+                ctx.beginPath();
+                ctx.arc(canvas.width - legendWidth + 6, top + 30 + j * 18, 5, 0, 2 * Math.PI);
+                ctx.fill();
+                ctx.fillStyle = "#333333";
+                ctx.fillText(String(entry[0]).substring(0, 20), canvas.width - legendWidth + 16, top + 34 + j * 18);
+            });
+        }
+    }
+
+    // PC1 of each sample against its position in the bicluster's sample order, coloured by a characteristic
+    function forkPlot(canvas, index, data, characteristic) {
+        var n = data.pc1.length;
+        var xs = [], colours = [], legend = null;
+        for (var i = 0; i < n; i++)
+            xs.push(i + 1);
+        if (characteristic && data.characteristics[characteristic]) {
+            var levels = index.characteristics[characteristic];
+            var codes = data.characteristics[characteristic];
+            colours = codes.map(function(c) { return c < 0 ? MISSING : PALETTE[c % PALETTE.length]; });
+            legend = levels.map(function(l, j) { return [l, PALETTE[j % PALETTE.length]]; });
+        } else {
+            colours = xs.map(function() { return PALETTE[5]; });
+        }
+        scatter(canvas, xs, data.pc1, colours, {xlabel: "Bic" + data.bicluster + " order", ylabel: "Bic" + data.bicluster + " PC1",
+                                                 legend: legend, legendTitle: characteristic, radius: 3});
+    }
+
+    // Correlation vectors of two biclusters against each other, the gene set of interest on
+    // top in red. The same bicluster twice plots its correlation vector against gene rank.
+    function cvPlot(canvas, index, x, y) {
+        var xs, ys = y.corvec;
+        if (x.bicluster == y.bicluster) {
+            var order = ys.map(function(v, i) { return i; }).sort(function(a, b) { return (ys[a] || 0) - (ys[b] || 0); });
+            xs = new Array(ys.length);
+            order.forEach(function(g, rank) { xs[g] = rank + 1; });
+        } else {
+            xs = x.corvec;
+        }
+        var inSet = {};
+        index.geneset.forEach(function(g) { inSet[g] = true; });
+        var colours = ys.map(function(v, i) { return inSet[i] ? "#E41A1C" : MISSING; });
+        var rest = ys.map(function(v, i) { return i; }).filter(function(i) { return !inSet[i]; });
+        scatter(canvas, xs, ys, colours, {xlabel: x.bicluster == y.bicluster ? "Gene rank" : "Bic" + x.bicluster + " correlation",
+                                          ylabel: "Bic" + y.bicluster + " correlation", layers: [rest, index.geneset],
+                                          legend: [["Other genes", MISSING], ["Interest", "#E41A1C"]], legendTitle: "Gene set", radius: 1.5});
+    }
+
+    function download(canvas, name) {
+        var link = document.createElement("a");
+        link.download = name;
+        link.href = canvas.toDataURL("image/png");
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
+    }
+
+    return {forkPlot: forkPlot, cvPlot: cvPlot, download: download};
+})();
@@ -0,0 +1,77 @@
+import itertools
+import json
+import os
+import shutil
+
+from django.conf import settings
+from django.db.models import Count, Sum
+
+from mcbiclustweb import costmodel, gemstore, manifest
+from mcbiclustweb.models import Analysis, Artifact, StageMetric, user_directory_path
+
+# Parameter sweeps: an analysis started with every combination of several seed sizes, numbers
+# of iterations and runs and gene sets. Each combination is an analysis of its own, created
+# from the swept one with its GEM store hard linked, so the matrix, gene index and digest are
+# not parsed or hashed again, and runs with the same parameters are shared through the stage
+# cache. The combinations go through the queue like any started analysis.
+
+
+def parse_values(text):
+    # Positive integers separated by commas
+    values = [int(value) for value in text.split(',') if value.strip()]
+    if not values or min(values) < 1:
+        raise ValueError("expected positive integers")
+    return values
+
+
+def jobs(seed_sizes, iterations, num_runs, genesets, init_seed=""):
+    # Job of every combination, genesets are (name, genes) pairs
+    return [{'seed_size': seed_size, 'init_seed': init_seed, 'geneset': genes, 'geneset_name': name, 'iterations': n, 'num_runs': runs}
+            for (name, genes), seed_size, n, runs in itertools.product(genesets, seed_sizes, iterations, num_runs)]
+
+
+def estimate(a, jobs):
+    # Cost of running the combinations one after another, None if any cannot be estimated
+    total = {'compute': 0.0, 'runtime': 0.0, 'memory': 0.0, 'complete': True}
+    for job in jobs:
+        e = costmodel.estimate(a, job['seed_size'], job['iterations'], job['num_runs'], len(job['geneset']))
+        if e is None:
+            return None
+        total = {'compute': total['compute'] + e['compute'], 'runtime': total['runtime'] + e['runtime'],
+                 'memory': max(total['memory'], e['memory']), 'complete': total['complete'] and e['complete']}
+    return total
+
+
+def describe(job):
+    return "Seed size {0}, {1} iterations, {2} runs, gene set {3}".format(job['seed_size'], job['iterations'], job['num_runs'], job['geneset_name'])
+
+
+def create(a, job, number):
+    # New analysis for one combination, ready to be queued
+    name_length = Analysis._meta.get_field('name').max_length
+    description_length = Analysis._meta.get_field('description').max_length
+    combination = Analysis.objects.create(name="{0} #{1}".format(a.name, number)[:name_length], description=describe(job)[:description_length],
+                                          user=a.user, char_ok=a.char_ok, status="2. Ready for analysis", stage=2, sweep=a)
+    # Only the name of the series matrix is kept, its contents are in the linked store
+    combination.gem.name = user_directory_path(combination, os.path.basename(a.gem.name))
+    combination.save(update_fields=['gem'])
+
+    store_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user_id, a.id))
+    combination_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user_id, combination.id))
+    os.makedirs(combination_dir, exist_ok=True)
+    gemstore.link(store_dir, combination_dir)
+    if a.char_ok and os.path.exists(os.path.join(store_dir, 'characteristics.csv')):
+        shutil.copyfile(os.path.join(store_dir, 'characteristics.csv'), os.path.join(combination_dir, 'characteristics.csv'))
+        manifest.record(combination, combination_dir, 'characteristics.csv', 'characteristics')
+    return combination
+
+
+def compare(a):
+    # One row per combination of the sweep, with how many biclusters it found and the worker
+    # time it took, each counted in a single grouped query
+    combinations = list(a.combinations.order_by('id').only('id', 'name', 'status', 'stage', 'job'))
+    ids = [c.id for c in combinations]
+    biclusters = dict(Artifact.objects.filter(analysis__in=ids, kind='plotdata').values('analysis').annotate(n=Count('id')).values_list('analysis', 'n'))
+    compute = dict(StageMetric.objects.filter(analysis__in=ids).values('analysis').annotate(t=Sum('wall_time')).values_list('analysis', 't'))
+    return [{'analysis': c, 'job': json.loads(c.job) if c.job else {}, 'biclusters': biclusters.get(c.id, 0),
+             'compute': costmodel.duration(compute[c.id]) if c.id in compute else ""} for c in combinations]
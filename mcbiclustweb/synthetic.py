@@ -0,0 +1,53 @@
+import numpy as np
+
+# Synthetic GEO series matrix files for benchmarking: normally distributed expression with
+# biclusters planted as a shared sample profile across a subset of genes and samples, and
+# !Sample_characteristics rows that preprocess keeps.
+
+CHARACTERISTIC_LEVELS = 3
+
+
+def quote(value):
+    return '"{0}"'.format(value)
+
+
+def write_series_matrix(path, num_genes, num_samples, biclusters=2, bicluster_genes=50, bicluster_samples=None, characteristics=3, seed=0):
+    # Returns the genes and samples of each planted bicluster
+    rng = np.random.RandomState(seed)
+    if bicluster_samples is None:
+        bicluster_samples = max(num_samples // 4, 2)
+    genes = ['GENE{0:06d}'.format(i + 1) for i in range(num_genes)]
+    samples = ['GSM{0:07d}'.format(i + 1) for i in range(num_samples)]
+
+    gem = rng.normal(8, 1, (num_genes, num_samples))
+    planted = []
+    for b in range(biclusters):
+        rows = np.sort(rng.choice(num_genes, bicluster_genes, replace=False))
+        cols = np.sort(rng.choice(num_samples, bicluster_samples, replace=False))
+        # Genes of the bicluster follow one profile over its samples, some of them inverted
+        profile = rng.normal(0, 2, bicluster_samples)
+        signs = rng.choice([-1, 1], bicluster_genes)
+        gem[np.ix_(rows, cols)] += np.outer(signs, profile)
+        planted.append({'genes': [genes[i] for i in rows], 'samples': [samples[i] for i in cols]})
+
+    with open(path, 'w') as f:
+        f.write('!Series_title\t"Synthetic series matrix, {0} genes x {1} samples"\n'.format(num_genes, num_samples))
+        f.write('!Series_geo_accession\t"GSE0"\n')
+        f.write('\n')
+        f.write('\t'.join(['!Sample_title'] + [quote('sample ' + s) for s in samples]) + '\n')
+        f.write('\t'.join(['!Sample_geo_accession'] + [quote(s) for s in samples]) + '\n')
+        f.write('\t'.join(['!Sample_source_name_ch1'] + [quote('synthetic')] * num_samples) + '\n')
+        for c in range(characteristics):
+            levels = rng.randint(CHARACTERISTIC_LEVELS, size=num_samples)
+            f.write('\t'.join(['!Sample_characteristics_ch1'] + [quote('factor{0}: level{1}'.format(c + 1, l)) for l in levels]) + '\n')
+        # Membership of the planted biclusters, which the fork plots should separate
+        for b, bic in enumerate(planted):
+            members = set(bic['samples'])
+            f.write('\t'.join(['!Sample_characteristics_ch1'] + [quote('bicluster{0}: {1}'.format(b + 1, 'yes' if s in members else 'no')) for s in samples]) + '\n')
+        f.write('!series_matrix_table_begin\n')
+        f.write('\t'.join([quote('ID_REF')] + [quote(s) for s in samples]) + '\n')
+        for gene, row in zip(genes, gem):
+            f.write(quote(gene) + '\t' + '\t'.join('%.5f' % x for x in row) + '\n')
+        f.write('!series_matrix_table_end\n')
+
+    return planted
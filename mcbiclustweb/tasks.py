@@ -1,44 +1,222 @@
-from celery import shared_task
+from celery import Task, shared_task, chord
 from django.conf import settings
+from django.core.cache import caches
+import glob
+import inspect
 import os
 import random
+import re
+import uuid
 import numpy as np
 from math import ceil
 
-from mcbiclustweb.models import Profile, Analysis
+from mcbiclustweb.models import Analysis
+from mcbiclustweb import cache, cancellation, characteristics, checkpoint, engine, gemstore, lookup, manifest, metrics, plotdata, rruntime, scheduler, seriesmatrix
 
 import rpy2.robjects as ro
-from rpy2.robjects.packages import importr
 import rpy2.rinterface as ri
 
+# Data of the fork plots, and which biclusters and characteristics they can be drawn for
+FORK_DATA = 'fork_data.csv'
+# Longest a fork plot render is waited for before it is sent again
+FORK_PLOT_RENDER_SECONDS = 600
+
+
+def fail_analysis(analysis_id, generation=None):
+    # Failed status for a running analysis whose task raised, which gives its slot to the next
+    # analysis in the queue. Left alone once cancelled, restarted or already finished.
+    a = Analysis.objects.filter(id=analysis_id).first()
+    if a is None or cancellation.requested(analysis_id, generation) or not 3 <= a.stage < 12:
+        return
+    a.set_status(scheduler.failed_status(a.stage))
+
+
+class AnalysisTask(Task):
+    # Base of the tasks of a started analysis, an error none of their checks caught (in R or
+    # elsewhere) fails the analysis instead of leaving it holding its slot
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        params = inspect.signature(self.run).bind_partial(*args, **kwargs).arguments
+        if 'analysis_id' in params:
+            fail_analysis(params['analysis_id'], params.get('generation'))
+
+
+def r_to_array(m):
+    # R matrix or numeric data.frame to a genes x samples NumPy array
+    return np.array(ro.r['as.vector'](ro.r['as.matrix'](m))).reshape((ro.r.nrow(m)[0], ro.r.ncol(m)[0]), order='F')
+
+def array_to_r(x, rownames=ro.NULL, colnames=ro.NULL, chunk=engine.CHUNK_GENES):
+    # R double matrix filled in blocks of rows straight from x, which can be a float32 memory
+    # map, so the only full size copy is the one R holds
+    nrow, ncol = x.shape
+    m = ro.r['numeric'](nrow * ncol)
+    values = np.asarray(m.memoryview()).reshape((ncol, nrow))
+    for lo in range(0, nrow, chunk):
+        values[:, lo:lo + chunk] = x[lo:lo + chunk].T
+    m.do_slot_assign('dim', ro.IntVector([nrow, ncol]))
+    if rownames is not ro.NULL or colnames is not ro.NULL:
+        dimnames = ro.r.list(rownames if rownames is ro.NULL else ro.StrVector(rownames), colnames if colnames is ro.NULL else ro.StrVector(colnames))
+        m.do_slot_assign('dimnames', dimnames)
+    return m
+
+def gem_dtype():
+    # Precision of the GEM store, always float32 in low memory mode
+    return 'float32' if settings.MCBICLUST_LOW_MEMORY else settings.MCBICLUST_GEM_DTYPE
+
+def load_gem(store_dir):
+    # Memory-mapped GEM with its gene and sample names. Analyses preprocessed before the
+    # binary store existed get one built from gem.csv the first time they are used.
+    if not gemstore.exists(store_dir):
+        gem = ro.r['read.csv'](os.path.join(store_dir, 'gem.csv'), header=True, sep=" ", **{'check.names': False})
+        gemstore.write(store_dir, r_to_array(gem), list(ro.r.rownames(gem)), list(ro.r.colnames(gem)), dtype=gem_dtype())
+    return gemstore.load(store_dir)
+
+def hclust_dendrogram(linkage, cormat):
+    # Dendrogram of a SciPy linkage, with its branches reordered by the row means of cormat as
+    # heatmap.2 does with the trees it computes itself
+    merge, order = engine.hclust_merge(linkage)
+    tree = ro.r.list(merge=ro.r.matrix(ro.IntVector(merge.ravel(order='F')), ncol=2), height=ro.FloatVector(linkage[:, 2]), order=ro.IntVector(order), method='complete')
+    tree = ro.r.structure(tree, **{'class': 'hclust'})
+    return ro.r.reorder(ro.r['as.dendrogram'](tree), ro.r.rowMeans(cormat))
+
+def list_to_r(rows, vector):
+    # Rows of a 2D array to an unnamed R list of vectors
+    return ro.r.list(*[vector(row) for row in rows])
+
+def list_to_array(x):
+    return np.array([np.array(v) for v in x])
+
+def load_stage(store_dir, stage, stage_key):
+    # Result of a completed stage from the analysis checkpoints, or failing that from the shared cache
+    arrays = checkpoint.load(store_dir, stage, stage_key)
+    if arrays is not None:
+        return arrays
+    entry = cache.get(stage_key)
+    if entry is None:
+        return None
+    arrays = cache.arrays(entry)
+    cache.restore_files(entry, store_dir)
+    checkpoint.save(store_dir, stage, stage_key, arrays)
+    return arrays
+
+def save_stage(store_dir, stage, stage_key, arrays, files=()):
+    checkpoint.save(store_dir, stage, stage_key, arrays)
+    cache.put(stage_key, arrays, files)
+
+def find_seed_r(gem_sub, geneset, samples, seed_size, init_seed, iterations, run):
+    mcbiclust = rruntime.library('MCbiclust')
+    params = {'gem': array_to_r(gem_sub, geneset, samples), 'seed.size': seed_size, 'initial.seed': ri.IntSexpVector(init_seed), 'iterations': iterations}
+    # Seed R's generator too, so a run gives the same seed whichever worker picks it up
+    ro.r['set.seed'](run)
+    return mcbiclust.FindSeed(**params)
+
+def r_proposals(run, iterations, num_samples, seed_size):
+    # The draws FindSeed makes from R's generator after set.seed(run). Each iteration samples
+    # the replacement among the samples outside the seed, then the seed position it goes to
+    # (R evaluates the right hand side of new.seed[...] <- ... first).
+    ro.r['set.seed'](run)
+    draws = ro.r('''
+        function(iterations, n, k) {
+            x <- integer(2 * iterations)
+            for (i in seq_len(iterations)) {
+                x[2 * i - 1] <- sample.int(n - k, 1)
+                x[2 * i] <- sample.int(k, 1)
+            }
+            x
+        }
+    ''')(iterations, num_samples, seed_size)
+    draws = np.array(draws).reshape((iterations, 2)) - 1
+    return [(position, rank) for rank, position in draws]
+
+def gene_rows(genes, geneset):
+    # Rows of gene set genes already validated against the GEM
+    index = {}
+    for i, gene in enumerate(genes):
+        index.setdefault(gene, i)
+    return [index[gene] for gene in geneset]
+
+def cveval(mcbiclust, gem_sub, gem, seed):
+    params = {'gem.part': gem_sub, 'gem.all': gem, 'seed': seed, 'splits': 10}
+    return np.array(mcbiclust.CVEval(**params))
+
+def gene_vec(mcbiclust, gem_sub, seed):
+    # The first half of CVEval: the average expression profile of the highly correlated gene set genes
+    hicor_genes = mcbiclust.HclustGenesHiCor(gem_sub, seed, 10)
+    params = {'gem': gem_sub, 'top.genes': hicor_genes, 'seed.sort': seed}
+    return np.array(mcbiclust.GeneVecFun(**params))
+
+def char_codes(char, samples):
+    # Levels of each characteristics column, and the level of each GEM sample counted from 0
+    # with -1 where it is missing, keyed by the names the fork plots use
+    rows = {name: i for i, name in enumerate(ro.r['as.character'](char.rx2('gene.name')))}
+    sample_rows = np.array([rows.get(s, -1) for s in samples])
+    levels = {}
+    codes = {}
+    for i, name in enumerate(ro.r.colnames(char)):
+        if name == 'gene.name':
+            continue
+        column = ro.r['as.factor'](char.rx2(i + 1))
+        column_codes = np.array(ro.r['as.integer'](column), dtype=np.int64) - 1
+        column_codes = np.where(sample_rows >= 0, column_codes[sample_rows], -1)
+        levels[name.replace(".", "_")] = list(ro.r.levels(column))
+        codes[name.replace(".", "_")] = np.where(column_codes >= 0, column_codes, -1)
+    return levels, codes
+
+def gem_dims(store_dir):
+    gem = gemstore.load(store_dir)[0]
+    return {'genes': gem.shape[0], 'samples': gem.shape[1]}
+
 @shared_task
 def preprocess(analysis_id):
+    if cancellation.requested(analysis_id):
+        return "cancelled"
     a = Analysis.objects.get(id=analysis_id)
+    recorder = metrics.Recorder(a)
     # Get GEM directory
     gem_dir = os.path.join(settings.MEDIA_ROOT, a.gem.name)
     # Directory to store processed data
     store_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user.id, a.id))
 
-    ri.initr()
-
-    # Import libraries
-    base = importr('base')
-    geoquery = importr('GEOquery')
-
     # Check if file starts with !Series_title, otherwise getGEO never stops
-    with open(gem_dir) as f:
+    with open(gem_dir, errors='replace') as f:
         first_line = f.readline()
     if not first_line[:14].startswith("!Series_title\t"):
-        a.status = "-2. Preprocessing failed: invalid gene expression matrix format"
-        a.save()
+        a.set_status("-2. Preprocessing failed: invalid gene expression matrix format")
         return "invalid gene expression matrix format"
 
+    # Stream the series matrix straight into the GEM store and characteristics table,
+    # files the parser cannot handle go through GEOquery below
+    if settings.MCBICLUST_NATIVE_PARSER:
+        try:
+            samples, sample_fields = seriesmatrix.parse(gem_dir, store_dir, dtype=gem_dtype())
+        except seriesmatrix.SeriesMatrixError as e:
+            print("Series matrix parser failed, using GEOquery: {0}".format(e))
+        else:
+            try:
+                # Extract explicitly defined characteristics, as from GEOquery's pheno data below
+                names, columns = seriesmatrix.sample_table(sample_fields)
+                char_index = [re.search('characteristics|date', name) is None for name in names]
+                names = characteristics.make_names([name for name, keep in zip(names, char_index) if keep])
+                columns = [column for column, keep in zip(columns, char_index) if keep]
+                names, columns = characteristics.clean(names, columns)
+                characteristics.write_table(os.path.join(store_dir, 'characteristics.csv'), names + ['gene.name'], columns + [samples])
+                manifest.record(a, store_dir, 'characteristics.csv', 'characteristics')
+            except:
+                a.char_ok = False
+                a.save(update_fields=['char_ok'])
+
+            recorder.lap('preprocess', **gem_dims(store_dir))
+            a.set_status("2. Ready for analysis")
+
+            return "success"
+
+    # Libraries are already loaded in worker processes
+    geoquery = rruntime.library('GEOquery')
+
     # Get GEO series matrix and extract GEM
     try:
         gsm = geoquery.getGEO(filename=gem_dir, getGPL=False)
     except:
-        a.status = "-2. Preprocessing failed: invalid gene expression matrix format"
-        a.save()
+        a.set_status("-2. Preprocessing failed: invalid gene expression matrix format")
         return "invalid gene expression matrix format"
 
     try:
@@ -51,9 +229,10 @@ def preprocess(analysis_id):
         gem = gem.rx(row_keep, True)
         # Write to CSV
         ro.r['write.table'](gem, file=os.path.join(store_dir, 'gem.csv'))
+        # And to the binary store the analysis stages map
+        gemstore.write(store_dir, r_to_array(gem), list(ro.r.rownames(gem)), list(ro.r.colnames(gem)), dtype=gem_dtype())
     except:
-        a.status = "-2. Preprocessing failed: invalid gene expression matrix format"
-        a.save()
+        a.set_status("-2. Preprocessing failed: invalid gene expression matrix format")
         return "invalid gene expression matrix format"
 
     try:
@@ -68,189 +247,349 @@ def preprocess(analysis_id):
         char = ro.r['data.frame'](ro.r.lapply(char, ro.r['as.character']), stringsAsFactors=False)
         char = ro.r.cbind(char, **{'gene.name': gene_name}, stringsAsFactors=False)
 
-        # Data cleaning
-        for i in range(char.nrow):
-            for j in range(char.ncol - 1):
-                char_val = char.rx(i + 1, j + 1)[0].strip()
-                if char_val == "":
-                    char.rx[i + 1, j + 1] = "unknown"
-                elif char_val == "None" or char_val == "NONE" or char_val == "none":
-                    char.rx[i + 1, j + 1] = "none"
-                else:
-                    char.rx[i + 1, j + 1] = char_val
-
-        # Remove columns where more than 80% of unique values have less than 5 occurrences
+        # Data cleaning, one column at a time in NumPy rather than cell by cell in R
         col_keep = np.repeat([True], char.ncol)
         for i in range(char.ncol - 1):
-            unique_count = ro.r.table(char.rx(True, i + 1))
-            unique_length = ro.r.length(unique_count)[0]
-            if unique_length == 1:
+            values = characteristics.normalise(list(char.rx2(i + 1)))
+            # Remove columns where more than 80% of unique values have less than 5 occurrences
+            if not characteristics.keep_column(values):
                 col_keep[i] = False
                 continue
-            count = 0
-            for j in range(unique_length):
-                if ro.r.names(unique_count).rx(j + 1)[0] == "unknown":
-                    unique_length = unique_length - 1
-                elif unique_count.rx(j + 1)[0] < 5:
-                    count = count + 1
-            if count / unique_length > 0.8:
-                col_keep[i] = False
+            # Change all values with less than 5 occurences to "Other"
+            char.rx2[i + 1] = ro.StrVector(characteristics.collapse_rare(values))
 
-        char = char.rx(True,ro.BoolVector(col_keep))
-
-        # Change all values with less than 5 occurences to "Other"
-        for i in range(char.ncol - 1):
-            rare_char = np.where(np.array(ro.r.table(char.rx2(i + 1))) < 5)[0] + 1
-            rare_char = ro.r.names(ro.r.table(char.rx2(i + 1))).rx(ro.IntVector(rare_char))
-            if ro.r.length(rare_char)[0] == 1:
-                rare_char = ro.IntVector([])
-            if ro.r.length(rare_char)[0] != 0:
-                for j in range(char.nrow):
-                    if str(char.rx(j + 1, i + 1)[0]) in np.array(rare_char):
-                        print(np.array(rare_char))
-                        char.rx[j + 1, i + 1] = "Other"
+        char = char.rx(True, ro.BoolVector(col_keep))
 
         # Write to CSV
         ro.r['write.table'](char, file=os.path.join(store_dir, 'characteristics.csv'))
+        manifest.record(a, store_dir, 'characteristics.csv', 'characteristics')
     except:
         a.char_ok = False
-        a.save()
+        a.save(update_fields=['char_ok'])
 
-    a.status = "2. Ready for analysis"
-    a.save()
+    recorder.lap('preprocess', **gem_dims(store_dir))
+    a.set_status("2. Ready for analysis")
 
     return "success"
 
 
 @shared_task
-def runFindSeed(analysis_id, seed_size, init_seed, geneset, iterations, num_runs):
+def evictCache():
+    # Keep the stage cache within its budget, run by celery beat rather than on every write
+    return "cache at {0} bytes".format(cache.evict())
+
+
+@shared_task
+def dispatchAnalyses():
+    # Start queued analyses while there are free slots, called when an analysis is queued or
+    # finishes and periodically by celery beat
+    claimed = scheduler.claim()
+    for analysis_id, job, generation in claimed:
+        result = runFindSeed.delay(analysis_id, job['seed_size'], job['init_seed'], job['geneset'], job['iterations'], job['num_runs'], generation)
+        cancellation.track(analysis_id, [result.id])
+    return "started {0} analyses".format(len(claimed))
+
+
+@shared_task
+def failAnalysis(analysis_id, generation=None):
+    # Error callback of the chords, whose callback never runs when one of their tasks fails
+    fail_analysis(analysis_id, generation)
+    return "failed"
+
+
+@shared_task(base=AnalysisTask)
+def runFindSeed(analysis_id, seed_size, init_seed, geneset, iterations, num_runs, generation=None):
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
     a = Analysis.objects.get(id=analysis_id)
     # Get GEM directory
     gem_dir = os.path.join(settings.MEDIA_ROOT, a.gem.name)
     # Directory to store figures
     fig_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user.id, a.id))
 
-    ri.initr()
-
-    # Imports libraries
-    mcbiclust = importr('MCbiclust')
-    geoquery = importr('GEOquery')
-    gplots = importr('gplots')
-    ggplot2 = importr('ggplot2')
-    grdevices = importr('grDevices')
-    dplyr = importr('dplyr', on_conflict="warn")
-    gtools = importr("gtools")
-    stringr = importr("stringr")
-
-    gem = ro.r['read.csv'](os.path.join(fig_dir, 'gem.csv'), header=True, sep=" ")
+    gem, genes, samples = load_gem(fig_dir)
+    gene_index, sample_index = gemstore.load_index(fig_dir)
+    status_length = Analysis._meta.get_field('status').max_length
 
-    # Check that gene expression matrix contains the genes in gene set of interest 
-    for x in geneset:
-        if x not in np.array(ro.r.rownames(gem)):
-            print(x)
-            a.status = "-1. Failed: geneset of interest contains genes that are either not in the series matrix or have NA or 0 as value"
-            a.save()
-            return "geneset of interest contains genes that are either not in the series matrix or have NA or 0 as value"
-
-    gem_sub = gem.rx(ro.StrVector(geneset), True)
+    # Check that gene expression matrix contains the genes in gene set of interest, all in one
+    # pass through the gene index so every missing gene is reported
+    rows, missing = lookup.resolve(gene_index, geneset, settings.MCBICLUST_MATCH_IGNORE_CASE, lookup.aliases(settings.MCBICLUST_GENE_ALIASES))
+    if missing:
+        print(missing)
+        a.set_status(lookup.missing_message("-1. Failed: geneset of interest contains genes that are either not in the series matrix or have NA or 0 as value", missing, status_length))
+        return "geneset of interest contains genes that are either not in the series matrix or have NA or 0 as value: " + ", ".join(missing)
+    # Genes matched by case or alias go by their name in the GEM from here on
+    geneset = [genes[row] for row in rows]
 
     # Checks if the seed size user inputed is bigger than the number of samples in GEM
-    if gem.ncol < seed_size:
-        a.status = "-1. Failed: sample seed size bigger than sample number"
-        a.save()
+    if len(samples) < seed_size:
+        a.set_status("-1. Failed: sample seed size bigger than sample number")
         return "sample seed size bigger than number of samples"
     # Checks if one of the initial seeds specified is bigger than the number of samples in GEM
-    init_seed_specified = False
     if init_seed != "":
-        init_seed_specified = True
-        temp = np.array(ro.StrVector(init_seed.split(',')))
+        temp = [s.strip() for s in init_seed.split(',')]
         print(temp)
-        for s in temp:
-            print(s)
-            if s not in np.array(ro.r.colnames(gem)):
-                a.status = "-1. Failed: one initial seed sample is not in gene expression matrix"
-                a.save()
-                return "one initial seed sample is not in gene expression matrix"
-        init_seed = []
-        for s in temp:
-            print(np.where(np.array(ro.r.colnames(gem))==s))
-            init_seed.append(np.where(np.array(ro.r.colnames(gem))==s)[0][0]+1)
-
-    # Find seeds
-    multi_seed = ro.ListVector({})
-    for i in range(num_runs):
-        # Create parameters for FindSeed
-        if init_seed_specified == True:
-            init_seed = ro.IntVector(init_seed)
-            params = {'gem': gem_sub, 'seed.size': seed_size, 'initial.seed': init_seed, 'iterations': iterations}
+        rows, missing = lookup.resolve(sample_index, temp, settings.MCBICLUST_MATCH_IGNORE_CASE)
+        if missing:
+            a.set_status(lookup.missing_message("-1. Failed: initial seed samples not in gene expression matrix", missing, status_length))
+            return "initial seed samples not in gene expression matrix: " + ", ".join(missing)
+        init_seed = [row + 1 for row in rows]
+    else:
+        init_seed = None
+
+    # Hash of the GEM contents, which keys the cached and checkpointed stage results. Checkpoints
+    # left by a run with other inputs are removed, those of the same run are resumed from.
+    gem_digest = gemstore.digest(fig_dir)
+    checkpoint.reset(fig_dir, cache.key(gem_digest, 'run', geneset, seed_size, init_seed, iterations, num_runs))
+    manifest.clear(a)
+
+    # Find seeds, one subtask per run
+    a.start_progress(num_runs)
+    if settings.MCBICLUST_FINDSEED_FANOUT:
+        check_runs = min(settings.MCBICLUST_FINDSEED_CHECK_RUNS, num_runs) if settings.MCBICLUST_FINDSEED_ENGINE == 'numpy' else 0
+        if check_runs:
+            # The runs checked against FindSeed in R go first in a chord of their own, so
+            # every other run knows whether the NumPy engine can be used
+            runs = [findSeedRun.s(analysis_id, i, seed_size, init_seed, geneset, iterations, generation) for i in range(check_runs)]
+            callback = sendSeedRuns.s(analysis_id, seed_size, init_seed, geneset, iterations, num_runs, generation).set(link_error=[failAnalysis.si(analysis_id, generation)])
+            cancellation.track(analysis_id, [run.freeze().id for run in runs] + [callback.freeze().id])
+            chord(runs)(callback)
+            return "started {0} checked FindSeed runs".format(check_runs)
+        return send_seed_runs([], analysis_id, seed_size, init_seed, geneset, iterations, num_runs, generation)
+
+    runs = [findSeedRun.s(analysis_id, i, seed_size, init_seed, geneset, iterations, generation) for i in range(num_runs)]
+    return runAnalysis([run() for run in runs], analysis_id, geneset, iterations, generation)
+
+
+def send_seed_runs(checked, analysis_id, seed_size, init_seed, geneset, iterations, num_runs, generation):
+    # Chord of the runs after the checked ones, whose seeds are handed on to runAnalysis
+    runs = [findSeedRun.s(analysis_id, i, seed_size, init_seed, geneset, iterations, generation) for i in range(len(checked), num_runs)]
+    callback = runAnalysis.s(analysis_id, geneset, iterations, generation, checked).set(link_error=[failAnalysis.si(analysis_id, generation)])
+    if not runs:
+        return callback([])
+    cancellation.track(analysis_id, [run.freeze().id for run in runs] + [callback.freeze().id])
+    chord(runs)(callback)
+    return "started {0} FindSeed runs".format(len(runs))
+
+
+@shared_task(base=AnalysisTask)
+def sendSeedRuns(checked, analysis_id, seed_size, init_seed, geneset, iterations, num_runs, generation=None):
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+    return send_seed_runs(checked, analysis_id, seed_size, init_seed, geneset, iterations, num_runs, generation)
+
+
+@shared_task(base=AnalysisTask)
+def findSeedRun(analysis_id, run, seed_size, init_seed, geneset, iterations, generation=None):
+    # Runs of a cancelled analysis are skipped, runAnalysis stops before using their seeds
+    if cancellation.requested(analysis_id, generation):
+        return [run, None]
+    a = Analysis.objects.get(id=analysis_id)
+    fig_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user.id, a.id))
+
+    recorder = metrics.Recorder(a, seed_size=seed_size, iterations=iterations)
+
+    # Reuse the seed if this run was already done on the same GEM and parameters
+    seed_key = cache.key(gemstore.digest(fig_dir), 'seed', geneset, seed_size, init_seed, iterations, run)
+    # Kept once a checked run found the NumPy engine differs from FindSeed on these inputs
+    mismatch_key = cache.key(gemstore.digest(fig_dir), 'findseed-mismatch', geneset, seed_size, init_seed, iterations)
+    result = load_stage(fig_dir, 'seed%d' % run, seed_key)
+    if result is not None:
+        a.advance_progress()
+        return [run, [int(x) for x in result['seed']]]
+
+    # Only the gene set rows are read from the mapped GEM
+    gem, genes, samples = gemstore.load(fig_dir)
+    gem_sub = gem[gene_rows(genes, geneset)]
+
+    # Create parameters for FindSeed
+    if init_seed is None:
+        # Same initial seed as random.seed(run) followed by random.sample
+        init_seed = random.Random(run).sample(list(range(1, len(samples) + 1)), seed_size)
+
+    mismatch = False
+    try:
+        if settings.MCBICLUST_FINDSEED_ENGINE == 'numpy' and load_stage(fig_dir, 'findseed_mismatch', mismatch_key) is None:
+            # Same swaps as FindSeed in R after set.seed(run), so the same seed comes out
+            proposals = r_proposals(run, iterations, len(samples), seed_size)
+            seed = engine.find_seed(gem_sub, seed_size, np.array(init_seed) - 1, proposals) + 1
+            if run < settings.MCBICLUST_FINDSEED_CHECK_RUNS:
+                r_seed = find_seed_r(gem_sub, geneset, samples, seed_size, init_seed, iterations, run)
+                if list(seed) != list(r_seed):
+                    print("NumPy FindSeed differs from MCbiclust, using MCbiclust for every run.")
+                    seed = r_seed
+                    mismatch = True
         else:
-            random.seed(i)
-            init_seed = ri.IntSexpVector(random.sample(list(range(1, gem.ncol + 1)), seed_size))
-            params = {'gem': gem_sub, 'seed.size': seed_size, 'initial.seed': init_seed, 'iterations': iterations}
-        # Perform FindSeed
-        seed = mcbiclust.FindSeed(**params)
-        print(seed)
-        multi_seed.rx2[i + 1] = seed
+            seed = find_seed_r(gem_sub, geneset, samples, seed_size, init_seed, iterations, run)
+    except:
+        a.set_status("-1. Failed: error finding seeds, please try to restart the analysis")
+        raise
+    print(seed)
+
+    # The analysis directory and rows are gone once it is deleted, nothing is written for it
+    if cancellation.requested(analysis_id, generation):
+        return [run, None]
+    seed = [int(x) for x in seed]
+    if mismatch:
+        save_stage(fig_dir, 'findseed_mismatch', mismatch_key, {})
+    save_stage(fig_dir, 'seed%d' % run, seed_key, {'seed': np.array(seed)})
+    recorder.lap('findseed', genes=len(geneset), samples=len(samples))
+    a.advance_progress()
+    return [run, seed]
+
+
+@shared_task(base=AnalysisTask)
+def runAnalysis(seeds, analysis_id, geneset, iterations=None, generation=None, checked=()):
+    # Checked between stages, so a cancelled analysis frees the worker within one stage.
+    # checked holds the seeds of the runs done before the others were sent.
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+    a = Analysis.objects.get(id=analysis_id)
+    fig_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user.id, a.id))
+
+    # Libraries are already loaded in worker processes
+    mcbiclust = rruntime.library('MCbiclust')
+    gplots = rruntime.library('gplots')
+    ggplot2 = rruntime.library('ggplot2')
+    grdevices = rruntime.library('grDevices')
+    dplyr = rruntime.library('dplyr')
+
+    # In low memory mode the full GEM never goes into R here, the correlation vectors are always
+    # batched in NumPy and the top genes and seed of each bicluster are picked in NumPy
+    low_memory = settings.MCBICLUST_LOW_MEMORY
+    gem_array, genes, samples = gemstore.load(fig_dir)
+    gem = None if low_memory else array_to_r(gem_array, genes, samples)
+    geneset_loc = gene_rows(genes, geneset)
+    gem_sub = array_to_r(gem_array[geneset_loc], geneset, samples)
+
+    # Put the seeds back in run order, subtasks may finish in any order
+    seeds = [seed for run, seed in sorted(list(seeds) + list(checked))]
+    num_runs = len(seeds)
+    multi_seed = list_to_r(seeds, ro.IntVector)
+    recorder = metrics.Recorder(a, genes=len(genes), samples=len(samples), runs=num_runs, seed_size=len(seeds[0]), iterations=iterations)
     print("Found seeds.")
-    a.status = "4. Started analysis: found seeds"
-    a.save()
-
-    # Calculate correlation vector for each run
-    multi_corvec = ro.ListVector({})
-    for i in range(num_runs):
-        params = {'gem.part': gem_sub, 'gem.all': gem, 'seed': multi_seed.rx2(i + 1), 'splits': 10}
-        corvec = mcbiclust.CVEval(**params)
-        multi_corvec.rx2[i + 1] = corvec
+    a.set_status("4. Started analysis: found seeds")
+
+    # Calculate correlation vector for each run, straight into a genes x runs array
+    cormat_key = cache.key(gemstore.digest(fig_dir), 'cormat', geneset, seeds)
+    result = load_stage(fig_dir, 'cormat', cormat_key)
+    if result is not None:
+        multi_cormat = result['cormat']
+    elif settings.MCBICLUST_CVEVAL_ENGINE == 'numpy' or low_memory:
+        multi_cormat = np.empty((len(genes), num_runs))
+        # Only the reference gene vector of each run comes from R, the correlations with
+        # every gene of the GEM are done for all runs at once
+        gene_vecs = [gene_vec(mcbiclust, gem_sub, multi_seed.rx2(i + 1)) for i in range(num_runs)]
+        engine.batch_corvecs(gem_array, [np.array(seed) - 1 for seed in seeds], gene_vecs, out=multi_cormat)
+        # Compare a few runs against CVEval and fall back to it if they differ
+        for i in range(0 if low_memory else min(settings.MCBICLUST_CVEVAL_CHECK_RUNS, num_runs)):
+            if not engine.corvecs_agree(multi_cormat[:, i], cveval(mcbiclust, gem_sub, gem, multi_seed.rx2(i + 1))):
+                print("Batched correlation vectors differ from CVEval, using CVEval.")
+                for j in range(num_runs):
+                    multi_cormat[:, j] = cveval(mcbiclust, gem_sub, gem, multi_seed.rx2(j + 1))
+                break
+    else:
+        multi_cormat = np.empty((len(genes), num_runs))
+        for i in range(num_runs):
+            multi_cormat[:, i] = cveval(mcbiclust, gem_sub, gem, multi_seed.rx2(i + 1))
+    # Checked before anything is written, a deleted analysis must not get its directory back
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+    if result is None:
+        save_stage(fig_dir, 'cormat', cormat_key, {'cormat': multi_cormat})
+    recorder.lap('cormat')
     print("Calculated correlation vector.")
-    a.status = "5. Started analysis: calculated correlation vector"
-    a.save()
-
-    # Turn correlation vectors to correlation matrix
-    len_a = ro.r.length(multi_corvec.rx2(1))[0]
-    len_b = ro.r.length(multi_corvec)[0]
-    multi_cormat=ro.r.matrix(0.0, len_a, len_b)
-    for i in range(num_runs):
-        multi_cormat.rx[True, i + 1] = multi_corvec.rx2(i + 1)
-    multi_corvec = None
+    a.set_status("5. Started analysis: calculated correlation vector")
+
+    # Turn correlation vectors to correlation matrix, with the numpy engine the run x run
+    # correlations are computed once here for both the heatmap and the clusters
+    numpy_clusters = settings.MCBICLUST_CLUSTER_ENGINE == 'numpy'
+    if numpy_clusters:
+        run_cor = engine.run_correlations(multi_cormat)
+    multi_cormat = array_to_r(multi_cormat)
     print("Created correlation matrix.")
-    a.status = "6. Started analysis: created correlation matrix"
-    a.save()
+    a.set_status("6. Started analysis: created correlation matrix")
+
+    # The clustering of the runs the groups are cut from also gives the heatmap's dendrogram.
+    # It fails like finding the groups does, NAs or too few runs are not a plotting error.
+    clusters_key = cache.key(cormat_key, 'clusters', 20, settings.MCBICLUST_CLUSTER_ENGINE)
+    result = load_stage(fig_dir, 'clusters', clusters_key)
+    if numpy_clusters:
+        try:
+            clusters = result if result is not None else engine.cluster_runs(run_cor, 20)
+        except:
+            a.set_status("-4. Failed: error finding distinct biclusters, your gene expression matrix may not be suitable for analysis")
+            return "error finding distinct biclusters, your gene expression matrix may not be suitable for analysis"
+        if cancellation.requested(analysis_id, generation):
+            return "cancelled"
 
     # Plot correlation heatmap
     try:
-        cormat1 = ro.r.abs(ro.r.cor(multi_cormat, use='complete.obs'))
-        cordist = ro.r("""
-            function(c){
-                as.dist(1 - abs(c))
-            }
-        """)
-        grdevices.png(file=os.path.join(fig_dir, "cor_heatmap.png"), width=1400, height=875, pointsize=25)
-        cormat_heat = gplots.heatmap_2(cormat1, trace="none", distfun=cordist)
-        grdevices.dev_off()
+        if numpy_clusters:
+            cormat1 = array_to_r(run_cor)
+            dendrogram = hclust_dendrogram(clusters['linkage'], cormat1)
+            grdevices.png(file=os.path.join(fig_dir, "cor_heatmap.png"), width=1400, height=875, pointsize=25)
+            cormat_heat = gplots.heatmap_2(cormat1, trace="none", Rowv=dendrogram, Colv=dendrogram)
+            grdevices.dev_off()
+        else:
+            cormat1 = ro.r.abs(ro.r.cor(multi_cormat, use='complete.obs'))
+            if cancellation.requested(analysis_id, generation):
+                return "cancelled"
+            cordist = ro.r("""
+                function(c){
+                    as.dist(1 - abs(c))
+                }
+            """)
+            grdevices.png(file=os.path.join(fig_dir, "cor_heatmap.png"), width=1400, height=875, pointsize=25)
+            cormat_heat = gplots.heatmap_2(cormat1, trace="none", distfun=cordist)
+            grdevices.dev_off()
+        manifest.record(a, fig_dir, "cor_heatmap.png", 'heatmap')
     except:
-        a.status = "-3. Failed: error plotting correlation heatmap, your gene expression matrix may not be suitable for analysis"
-        a.save()
+        a.set_status("-3. Failed: error plotting correlation heatmap, your gene expression matrix may not be suitable for analysis")
         return "error plotting correlation heatmap, your gene expression matrix may not be suitable for analysis"
+    recorder.lap('heatmap')
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
     print("Plotted heatmap")
-    a.status = "7. Started analysis: plotted heatmap"
-    a.save()
+    a.set_status("7. Started analysis: plotted heatmap")
 
     # Find clusters and plot them
     try:
-        grdevices.png(file=os.path.join(fig_dir, "sil_clust%02d.png"), width=1400, height=875, pointsize=25)
-        params = {'cor.vec.mat': multi_cormat, 'max.clusters': 20, 'plots': True, 'rand.vec': False}
-        multi_clust_group = mcbiclust.SilhouetteClustGroups(**params)
-        grdevices.dev_off()
+        if result is not None:
+            multi_clust_group = list_to_r(result['groups'], ro.BoolVector)
+        elif numpy_clusters:
+            grdevices.png(file=os.path.join(fig_dir, "sil_clust%02d.png"), width=1400, height=875, pointsize=25)
+            ks = ro.IntVector(range(2, len(clusters['widths']) + 2))
+            ro.r.plot(ks, ro.FloatVector(clusters['widths']), type='l', xlab='Number of clusters', ylab='Average silhouette width')
+            # Silhouette of the chosen cut, the second figure SilhouetteClustGroups draws
+            dist = 1 - run_cor
+            np.fill_diagonal(dist, 0)
+            labels = ro.IntVector(np.argmax(clusters['groups'], axis=0) + 1)
+            ro.r.plot(ro.r('cluster::silhouette')(labels, ro.r['as.dist'](array_to_r(dist))))
+            grdevices.dev_off()
+            multi_clust_group = list_to_r(clusters['groups'], ro.BoolVector)
+            save_stage(fig_dir, 'clusters', clusters_key, clusters, glob.glob(os.path.join(fig_dir, "sil_clust*.png")))
+        else:
+            grdevices.png(file=os.path.join(fig_dir, "sil_clust%02d.png"), width=1400, height=875, pointsize=25)
+            params = {'cor.vec.mat': multi_cormat, 'max.clusters': 20, 'plots': True, 'rand.vec': False}
+            multi_clust_group = mcbiclust.SilhouetteClustGroups(**params)
+            grdevices.dev_off()
+            if cancellation.requested(analysis_id, generation):
+                return "cancelled"
+            save_stage(fig_dir, 'clusters', clusters_key, {'groups': list_to_array(multi_clust_group).astype(bool)}, glob.glob(os.path.join(fig_dir, "sil_clust*.png")))
+        for path in sorted(glob.glob(os.path.join(fig_dir, "sil_clust*.png"))):
+            manifest.record(a, fig_dir, os.path.basename(path), 'silhouette')
     except:
-        a.status = "-4. Failed: error finding distinct biclusters, your gene expression matrix may not be suitable for analysis"
-        a.save()
+        a.set_status("-4. Failed: error finding distinct biclusters, your gene expression matrix may not be suitable for analysis")
         return "error finding distinct biclusters, your gene expression matrix may not be suitable for analysis"
+    recorder.lap('clusters')
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
     print("Plotted silhouette")
-    a.status = "8. Started analysis: plotted silhouette"
-    a.save()
+    a.set_status("8. Started analysis: plotted silhouette")
 
     # CVPlot
-    gene_names = ro.r.rownames(gem)
+    gene_names = ro.StrVector(genes)
     average_corvec = ro.ListVector({})
     for i in range(ro.r.length(multi_clust_group)[0]):
         x = ro.IntVector(np.argwhere(np.array(multi_clust_group.rx2(i + 1)) == 1) + 1)
@@ -258,15 +597,25 @@ def runFindSeed(analysis_id, seed_size, init_seed, geneset, iterations, num_runs
             average_corvec.rx2[i + 1] = multi_cormat.rx(True,x)
         else:
             average_corvec.rx2[i + 1] = ro.r.rowMeans(multi_cormat.rx(True,x))
-    geneset_loc = []
-    for gene in geneset:
-        geneset_loc.append(np.where(np.array(ro.r.rownames(gem))==gene)[0][0])
-    params = {'cv.df': ro.r['as.data.frame'](average_corvec), 'geneset.loc': ro.IntVector(geneset_loc), 'geneset.name': 'Interest', 'alpha1': 0.1}
-    cvplot = mcbiclust.CVPlot(**params)
-    ggplot2.ggsave("cvplot.png", plot=cvplot, device='png', path=fig_dir, width=4.7, height=2.9)
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+    # Plot data for the browser, the sample order and PC1 values are added once computed
+    nbiclusters = ro.r.length(multi_clust_group)[0]
+    path = plotdata.write(fig_dir, plotdata.INDEX_FILE, {'biclusters': nbiclusters, 'geneset': [int(x) for x in geneset_loc], 'characteristics': {}})
+    manifest.record(a, fig_dir, path, 'plotindex')
+    for i in range(nbiclusters):
+        path = plotdata.write(fig_dir, plotdata.bicluster_file(i + 1), {'bicluster': i + 1, 'corvec': plotdata.values(average_corvec.rx2(i + 1))})
+        manifest.record(a, fig_dir, path, 'plotdata', i + 1)
+    if settings.MCBICLUST_PNG_PLOTS:
+        params = {'cv.df': ro.r['as.data.frame'](average_corvec), 'geneset.loc': ro.IntVector(geneset_loc), 'geneset.name': 'Interest', 'alpha1': 0.1}
+        cvplot = mcbiclust.CVPlot(**params)
+        ggplot2.ggsave("cvplot.png", plot=cvplot, device='png', path=fig_dir, width=4.7, height=2.9)
+        manifest.record(a, fig_dir, "cvplot.png", 'cvplot')
+    recorder.lap('cvplot')
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
     print("Plotted CVPlot")
-    a.status = "9. Started analysis: plotted CVPlot"
-    a.save()
+    a.set_status("9. Started analysis: plotted CVPlot")
 
     # Gene set enrichment
     # corvec_gsea = ro.ListVector({})
@@ -280,79 +629,228 @@ def runFindSeed(analysis_id, seed_size, init_seed, geneset, iterations, num_runs
     # a.status = "10. Started analysis: calculated gene set enrichment"
     # a.save()
 
-    # Sample sorting
-    multi_samp_sort = ro.ListVector({})
-    params = {'gem': gem, 'av.corvec': average_corvec, 'top.genes.num': 750, 'groups': multi_clust_group, 'initial.seeds': multi_seed}
-    multi_prep = mcbiclust.MultiSampleSortPrep(**params)
-    for i in range(ro.r.length(multi_prep.rx2(1))[0]):
-        print(i)
-        params = {'gem': multi_prep.rx2(1).rx2(i + 1), 'seed': multi_prep.rx2(2).rx2(i + 1)}
-        multi_samp_sort.rx2[i + 1] = mcbiclust.SampleSort(**params)
-    print("Sample sorting finished")
-    a.status = "10. Started analysis: sample sorting finished"
-    a.save()
-
-    # Calculate PC1 values and threshold new biclusters
-    multi_pc1_vec = ro.ListVector({})
-    multi_bic = ro.ListVector({})
+    # Sample sorting, PC1 and thresholding of each bicluster, one subtask per bicluster. The
+    # average correlation vectors are checkpointed for the subtasks, and the top genes and seed
+    # of each bicluster are only needed for biclusters that are not cached.
+    corvecs_key = cache.key(clusters_key, 'corvecs')
+    save_stage(fig_dir, 'corvecs', corvecs_key, {'corvecs': np.column_stack([np.array(average_corvec.rx2(i + 1)) for i in range(nbiclusters)])})
+    bicluster_keys = [cache.key(clusters_key, 'bicluster', 750, b + 1) for b in range(nbiclusters)]
+    multi_prep = None
+    pending = any(load_stage(fig_dir, 'bic%d' % (b + 1), bicluster_keys[b]) is None for b in range(nbiclusters))
+    if pending and not low_memory:
+        params = {'gem': gem, 'av.corvec': average_corvec, 'top.genes.num': 750, 'groups': multi_clust_group, 'initial.seeds': multi_seed}
+        multi_prep = mcbiclust.MultiSampleSortPrep(**params)
+        if cancellation.requested(analysis_id, generation):
+            return "cancelled"
+    biclusters = []
+    for b in range(nbiclusters):
+        top_rows, seed = [], []
+        if multi_prep is not None:
+            top_rows = gene_rows(genes, list(ro.r.rownames(multi_prep.rx2(1).rx2(b + 1))))
+            seed = [int(x) for x in multi_prep.rx2(2).rx2(b + 1)]
+        elif pending:
+            # Only the 750 top gene rows of the bicluster are read from the mapped GEM
+            top_rows = engine.top_genes(np.array(average_corvec.rx2(b + 1)), 750).tolist()
+            group = [seeds[run] for run in np.flatnonzero(np.array(multi_clust_group.rx2(b + 1)))]
+            seed = group[engine.best_seed(gem_array[top_rows], [np.array(s) - 1 for s in group])]
+        biclusters.append(sortBicluster.s(analysis_id, b + 1, top_rows, seed, corvecs_key, bicluster_keys[b], generation))
+    if settings.MCBICLUST_BICLUSTER_FANOUT:
+        callback = finishBiclusters.s(analysis_id, bicluster_keys, generation).set(link_error=[failAnalysis.si(analysis_id, generation)])
+        cancellation.track(analysis_id, [bicluster.freeze().id for bicluster in biclusters] + [callback.freeze().id])
+        chord(biclusters)(callback)
+        return "started {0} bicluster subtasks".format(nbiclusters)
+
+    return finishBiclusters([bicluster() for bicluster in biclusters], analysis_id, bicluster_keys, generation)
+
+
+@shared_task(base=AnalysisTask)
+def sortBicluster(analysis_id, bicluster, top_rows, seed, corvecs_key, bicluster_key, generation=None):
+    # Returns [bicluster, error], error is None once the sample order and aligned PC1 of the
+    # bicluster are checkpointed. A failure only drops this bicluster from the analysis.
+    if cancellation.requested(analysis_id, generation):
+        return [bicluster, "cancelled"]
+    a = Analysis.objects.get(id=analysis_id)
+    fig_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user.id, a.id))
+    if load_stage(fig_dir, 'bic%d' % bicluster, bicluster_key) is not None:
+        return [bicluster, None]
+
+    mcbiclust = rruntime.library('MCbiclust')
+    gem_array, genes, samples = gemstore.load(fig_dir)
+    recorder = metrics.Recorder(a, genes=len(genes), samples=len(samples), seed_size=len(seed))
+    corvec = ro.FloatVector(load_stage(fig_dir, 'corvecs', corvecs_key)['corvecs'][:, bicluster - 1])
+    top_gem = array_to_r(gem_array[top_rows], [genes[row] for row in top_rows], samples)
     try:
-        for i in range(ro.r.length(multi_prep.rx2(1))[0]):
-            # Calculate PC1
-            params = {'top.gem': multi_prep.rx2(1).rx2(i + 1), 'seed.sort': multi_samp_sort.rx2(i + 1), 'n': min(ceil(ro.r.ncol(gem)[0]/20), 10)}
-            multi_pc1_vec.rx2[i + 1] = mcbiclust.PC1VecFun(**params)
-            # Threshold biclusters
-            params = {'cor.vec': average_corvec.rx2(i + 1), 'sort.order': multi_samp_sort.rx2(i + 1), 'pc1': multi_pc1_vec.rx2(i + 1), 'samp.sig': 0.05}
-            multi_bic.rx2[i + 1] = mcbiclust.ThresholdBic(**params)
-            # Align PC1
-            params = {'gem': gem, 'pc1': multi_pc1_vec.rx2(i + 1), 'sort.order': multi_samp_sort.rx2(i + 1), 'cor.vec': average_corvec.rx2(i + 1), 'bic': multi_bic.rx2(i + 1)}
-            multi_pc1_vec.rx2[i + 1] = mcbiclust.PC1Align(**params)
-    except:
-        a.status = "-5. Failed: error extending distinct biclusters, please try to restart the analysis. If this error is shown repeatedly, your gene expression matrix may not be suitable for analysis"
-        a.save()
+        # Sort the samples from the bicluster's seed
+        sort = mcbiclust.SampleSort(gem=top_gem, seed=ro.IntVector(seed))
+        # Calculate PC1
+        params = {'top.gem': top_gem, 'seed.sort': sort, 'n': min(ceil(len(samples)/20), 10)}
+        pc1 = mcbiclust.PC1VecFun(**params)
+        # Threshold bicluster
+        params = {'cor.vec': corvec, 'sort.order': sort, 'pc1': pc1, 'samp.sig': 0.05}
+        bic = mcbiclust.ThresholdBic(**params)
+        # Align PC1
+        if settings.MCBICLUST_LOW_MEMORY:
+            # PC1Align reads the GEM and correlation vector at the bicluster's genes only, so
+            # just those rows go into R, with the genes of the bicluster renumbered to match
+            bic_rows = [int(x) - 1 for x in bic.rx2(1)]
+            bic = ro.r.list(ro.IntVector(range(1, len(bic_rows) + 1)), bic.rx2(2))
+            params = {'gem': array_to_r(gem_array[bic_rows], [genes[row] for row in bic_rows], samples), 'pc1': pc1, 'sort.order': sort,
+                      'cor.vec': ro.FloatVector(np.array(corvec)[bic_rows]), 'bic': bic}
+        else:
+            params = {'gem': array_to_r(gem_array, genes, samples), 'pc1': pc1, 'sort.order': sort, 'cor.vec': corvec, 'bic': bic}
+        pc1 = mcbiclust.PC1Align(**params)
+    except Exception as e:
+        print("Bicluster {0} failed: {1}".format(bicluster, e))
+        return [bicluster, str(e) or type(e).__name__]
+    if cancellation.requested(analysis_id, generation):
+        return [bicluster, "cancelled"]
+    save_stage(fig_dir, 'bic%d' % bicluster, bicluster_key, {'sort': np.array(sort), 'pc1': np.array(pc1)})
+    recorder.lap('bicluster')
+    return [bicluster, None]
+
+
+@shared_task(base=AnalysisTask)
+def finishBiclusters(results, analysis_id, bicluster_keys, generation=None):
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+    a = Analysis.objects.get(id=analysis_id)
+    fig_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user.id, a.id))
+
+    dplyr = rruntime.library('dplyr')
+    gem_array, genes, samples = gemstore.load(fig_dir)
+    recorder = metrics.Recorder(a, genes=len(genes), samples=len(samples))
+
+    # Back in bicluster order, the biclusters that failed are left out and reported at the end
+    results = sorted(results)
+    failed = [bicluster for bicluster, error in results if error is not None]
+    biclusters = [bicluster for bicluster, error in results if error is None]
+    if not biclusters:
+        a.set_status("-5. Failed: error extending distinct biclusters, please try to restart the analysis. If this error is shown repeatedly, your gene expression matrix may not be suitable for analysis")
         return "error extending distinct biclusters, please try to restart the analysis. If this error is shown repeatedly, your gene expression matrix may not be suitable for analysis"
+    sorts, pc1s = {}, {}
+    for b in biclusters:
+        result = load_stage(fig_dir, 'bic%d' % b, bicluster_keys[b - 1])
+        sorts[b] = np.array(result['sort'], dtype=np.int64)
+        pc1s[b] = result['pc1']
+    print("Sample sorting finished")
+    a.set_status("10. Started analysis: sample sorting finished")
+
+    if a.char_ok:
+        char = ro.r['read.csv'](os.path.join(fig_dir,'characteristics.csv'), header=True, sep=" ", stringsAsFactors=True)
+        char_levels, codes = char_codes(char, samples)
+    else:
+        char_levels, codes = {}, {}
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+    for b in biclusters:
+        sort = sorts[b] - 1
+        path = plotdata.update(fig_dir, plotdata.bicluster_file(b), {'samples': [samples[j] for j in sort], 'pc1': plotdata.values(pc1s[b]),
+                                                                     'characteristics': {name: c[sort].tolist() for name, c in codes.items()}})
+        manifest.record(a, fig_dir, path, 'plotdata', b)
+    manifest.record(a, fig_dir, plotdata.update(fig_dir, plotdata.INDEX_FILE, {'characteristics': char_levels}), 'plotindex')
 
     multi_df_args = ro.ListVector({})
-    multi_df_args.rx2['gene.name'] = ro.r.colnames(gem)
-    for i in range(ro.r.length(multi_samp_sort)[0]):
-        multi_df_args.rx2["Bic" + str(i + 1) + ".order"] = ro.r.order(multi_samp_sort.rx2(i + 1))
-        multi_df_args.rx2["Bic" + str(i + 1) + ".PC1"] = multi_pc1_vec.rx2(i + 1).rx(ro.r.order(multi_samp_sort.rx2(i + 1)))
+    multi_df_args.rx2['gene.name'] = ro.StrVector(samples)
+    for b in biclusters:
+        order = ro.r.order(ro.IntVector(sorts[b]))
+        multi_df_args.rx2["Bic" + str(b) + ".order"] = order
+        multi_df_args.rx2["Bic" + str(b) + ".PC1"] = ro.FloatVector(pc1s[b]).rx(order)
     multi_df = ro.r['data.frame'](multi_df_args)
 
     if a.char_ok == False:
-        a.status = "12. Analysis completed"
-        a.save()
-        return "success"
+        recorder.lap('forkdata')
+        return finishAnalysis(analysis_id, generation, failed)
 
-    char = ro.r['read.csv'](os.path.join(fig_dir,'characteristics.csv'), header=True, sep=" ", stringsAsFactors=True)
     multi_df_char = dplyr.inner_join(multi_df,char,by="gene.name")
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+
+    # Keep the data the fork plots are drawn from, with the characteristics they can be coloured by
+    ro.r['write.table'](multi_df_char, file=os.path.join(fig_dir, FORK_DATA))
+    manifest.record(a, fig_dir, FORK_DATA, 'forkdata')
+    columns = list(ro.r.colnames(multi_df_char))[1 + len(biclusters) * 2:]
+    manifest.expect(a, 'forkplot', [(manifest.fork_plot_path(b, c), b, c) for b in biclusters for c in columns])
+    recorder.lap('forkdata')
+
+    # Render every fork plot in parallel across the workers, or leave them to be rendered
+    # the first time they are viewed
+    plots = [renderForkPlot.si(analysis_id, b, c) for b in biclusters for c in columns]
+    if settings.MCBICLUST_PNG_PLOTS and settings.MCBICLUST_FORK_PLOTS == 'eager' and plots:
+        callback = finishAnalysis.si(analysis_id, generation, failed).set(link_error=[failAnalysis.si(analysis_id, generation)])
+        cancellation.track(analysis_id, [plot.freeze().id for plot in plots] + [callback.freeze().id])
+        chord(plots)(callback)
+        return "rendering {0} fork plots".format(len(plots))
+
+    return finishAnalysis(analysis_id, generation, failed)
+
+
+@shared_task
+def renderForkPlot(analysis_id, bicluster, column):
+    if cancellation.requested(analysis_id):
+        return "cancelled"
+    a = Analysis.objects.get(id=analysis_id)
+    fig_dir = os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(a.user.id, a.id))
+
+    recorder = metrics.Recorder(a)
+
+    ggplot2 = rruntime.library('ggplot2')
+    gtools = rruntime.library('gtools')
+    stringr = rruntime.library('stringr')
+
+    multi_df_char = ro.r['read.csv'](os.path.join(fig_dir, FORK_DATA), header=True, sep=" ", stringsAsFactors=True, **{'check.names': False})
+    b = bicluster - 1
+    i = list(ro.r.colnames(multi_df_char)).index(column)
+    temp_name = column
+
+    legend = gtools.mixedsort(ro.r.names(ro.r.table(multi_df_char.rx(True, i + 1))))
+    legend_title = gtools.mixedsort(ro.r.names(ro.r.table(multi_df_char.rx(True, i + 1))))
+    for j in range(ro.r.length(legend_title)[0]):
+        legend_title.rx[j + 1] = stringr.str_wrap(legend_title.rx(j + 1),20)
+
+    ro.globalenv['multi_df_char'] = multi_df_char
+    forkplot = ro.r('ggplot(multi_df_char, aes(Bic%i.order,Bic%i.PC1)) + geom_point(aes(colour=%s)) + ylab("Bic%i PC1") + labs(colour="%s") + scale_color_discrete(breaks=%s,labels=%s)'%(b + 1, b + 1, temp_name, b + 1, temp_name,legend.r_repr(), legend_title.r_repr()))
+    del(ro.globalenv['multi_df_char'])
+    if cancellation.requested(analysis_id):
+        return "cancelled"
+
+    try:
+        os.makedirs(os.path.join(fig_dir,str(b + 1)))
+    except:
+        pass
+
+    ggplot2.ggsave("forkplot_%s.png"%(temp_name.replace(".", "_")), plot=forkplot, device='png', path=os.path.join(fig_dir,str(b + 1)), scale=1.5, width=12, height=7.4, units="cm")
+    manifest.record(a, fig_dir, manifest.fork_plot_path(bicluster, column), 'forkplot', bicluster, column)
+    recorder.lap('forkplot', samples=ro.r.nrow(multi_df_char)[0])
+    return "success"
+
+
+def fork_plot_render(artifact):
+    # Render of a fork plot not rendered yet. The first request for it sends the task, the
+    # requests made while it runs get the same one, and a render lost with its worker is sent
+    # again after FORK_PLOT_RENDER_SECONDS.
+    key = 'mcbiclustweb-forkplot-{0}'.format(artifact.id)
+    task_id = str(uuid.uuid4())
+    if caches['default'].add(key, task_id, FORK_PLOT_RENDER_SECONDS):
+        return renderForkPlot.apply_async((artifact.analysis_id, artifact.bicluster, artifact.characteristic), task_id=task_id)
+    result = renderForkPlot.AsyncResult(caches['default'].get(key, task_id))
+    if result.failed():
+        # Reported once, the next request renders it again
+        caches['default'].delete(key)
+    return result
+
+
+@shared_task(base=AnalysisTask)
+def finishAnalysis(analysis_id, generation=None, failed=()):
+    if cancellation.requested(analysis_id, generation):
+        return "cancelled"
+    a = Analysis.objects.get(id=analysis_id)
 
-    start = 1 + ro.r.length(multi_samp_sort)[0] * 2
-    end = multi_df_char.ncol
-    for b in range(ro.r.length(multi_samp_sort)[0]):
-        for i in range(start, end):
-            temp_name = ro.r.colnames(multi_df_char).rx(i + 1)[0]
-            
-            legend = gtools.mixedsort(ro.r.names(ro.r.table(multi_df_char.rx(True, i + 1))))
-            legend_title = gtools.mixedsort(ro.r.names(ro.r.table(multi_df_char.rx(True, i + 1))))
-            for j in range(ro.r.length(legend_title)[0]):
-                legend_title.rx[j + 1] = stringr.str_wrap(legend_title.rx(j + 1),20)
-            
-            ro.globalenv['multi_df_char'] = multi_df_char
-            forkplot = ro.r('ggplot(multi_df_char, aes(Bic%i.order,Bic%i.PC1)) + geom_point(aes(colour=%s)) + ylab("Bic%i PC1") + labs(colour="%s") + scale_color_discrete(breaks=%s,labels=%s)'%(b + 1, b + 1, temp_name, b + 1, temp_name,legend.r_repr(), legend_title.r_repr()))
-            del(ro.globalenv['multi_df_char'])
-            
-            try:
-                os.makedirs(os.path.join(fig_dir,str(b + 1)))
-            except:
-                pass
-            
-            ggplot2.ggsave("forkplot_%s.png"%(temp_name.replace(".", "_")), plot=forkplot, device='png', path=os.path.join(fig_dir,str(b + 1)), scale=1.5, width=12, height=7.4, units="cm")
-    
     print("Plotted forks")
-    a.status = "11. Started analysis: plotted forks"
-    a.save()
+    a.set_status("11. Started analysis: plotted forks")
 
-    a.status = "12. Analysis completed"
-    a.save()
+    if failed:
+        a.set_status("12. Analysis completed, bicluster {0} could not be extended".format(", ".join(str(b) for b in failed)))
+        return "success, without bicluster {0}".format(", ".join(str(b) for b in failed))
+    a.set_status("12. Analysis completed")
     return "success"
 
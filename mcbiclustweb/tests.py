@@ -1,3 +1,625 @@
-from django.test import TestCase
+import os
+import tempfile
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+from mcbiclustweb import api, cache as stage_cache, cancellation, characteristics, checkpoint, costmodel, engine, gemstore, lookup, scheduler, seriesmatrix, synthetic
+from mcbiclustweb.models import Analysis, Artifact, StageMetric
+
+
+def clean_loop(names, columns):
+    # The cell by cell cleaning preprocess did on the R data.frame before characteristics.clean
+    columns = [list(column) for column in columns]
+    for column in columns:
+        for i, value in enumerate(column):
+            value = value.strip()
+            if value == "":
+                column[i] = "unknown"
+            elif value == "None" or value == "NONE" or value == "none":
+                column[i] = "none"
+            else:
+                column[i] = value
+
+    kept_names, kept = [], []
+    for name, column in zip(names, columns):
+        unique_count = Counter(column)
+        unique_length = len(unique_count)
+        if unique_length == 1:
+            continue
+        count = 0
+        for value, n in unique_count.items():
+            if value == "unknown":
+                unique_length = unique_length - 1
+            elif n < 5:
+                count = count + 1
+        if count / unique_length > 0.8:
+            continue
+        kept_names.append(name)
+        kept.append(column)
+
+    for column in kept:
+        rare_char = [value for value, n in Counter(column).items() if n < 5]
+        if len(rare_char) == 1:
+            rare_char = []
+        for j, value in enumerate(column):
+            if value in rare_char:
+                column[j] = "Other"
+    return kept_names, kept
+
+
+def make_profile(username, last_dispatched=None):
+    profile = User.objects.create_user(username, password='password').profile
+    profile.last_dispatched = last_dispatched
+    profile.save()
+    return profile
+
+
+def make_analysis(profile, **fields):
+    fields = dict({'status': "2. Ready for analysis", 'stage': 2}, **fields)
+    return Analysis.objects.create(name="analysis", description="", user=profile, **fields)
+
+
+def silhouette_loop(dist, labels):
+    # Average silhouette width point by point, as cluster::silhouette
+    widths = []
+    for i, label in enumerate(labels):
+        own = [dist[i, j] for j in range(len(labels)) if labels[j] == label and j != i]
+        if not own:
+            widths.append(0.0)
+            continue
+        a = np.mean(own)
+        b = min(np.mean([dist[i, j] for j in range(len(labels)) if labels[j] == other]) for other in set(labels) if other != label)
+        widths.append(0.0 if a == b else (b - a) / max(a, b))
+    return np.mean(widths)
+
+
+def find_seed_loop(gem, initial_seed, proposals):
+    # FindSeed with the correlation matrix of the seed computed again for every swap
+    num_samples = gem.shape[1]
+    seed = list(initial_seed)
+    score = np.mean(np.abs(np.corrcoef(gem[:, seed])))
+    for position, rank in proposals:
+        outside = [j for j in range(num_samples) if j not in seed]
+        candidate = list(seed)
+        candidate[position] = outside[rank]
+        new_score = np.mean(np.abs(np.corrcoef(gem[:, candidate])))
+        if new_score > score:
+            seed, score = candidate, new_score
+    return seed
+
+
+class CharacteristicsTests(SimpleTestCase):
+    def test_clean_matches_loop(self):
+        rng = np.random.RandomState(0)
+        pool = ["a", " a", "b ", "", " ", "None", "NONE", "none", "c", "d", "e", "f", "g", "h"]
+        for trial in range(50):
+            num_samples = rng.randint(5, 60)
+            names = ['char{0}'.format(i) for i in range(6)]
+            columns = []
+            for i in range(len(names)):
+                levels = pool[:rng.randint(1, len(pool) + 1)]
+                weights = rng.dirichlet(np.ones(len(levels)) * rng.choice([0.2, 1.0, 5.0]))
+                columns.append(list(rng.choice(levels, num_samples, p=weights)))
+            expected_names, expected = clean_loop(names, columns)
+            kept_names, kept = characteristics.clean(names, columns)
+            self.assertEqual(kept_names, expected_names)
+            self.assertEqual([list(column) for column in kept], expected)
+
+    def test_single_value_column_dropped(self):
+        kept_names, kept = characteristics.clean(['x', 'y'], [["a"] * 10, ["a"] * 5 + ["b"] * 5])
+        self.assertEqual(kept_names, ['y'])
+
+
+class CorrelationVectorTests(SimpleTestCase):
+    def test_batch_corvecs_matches_corrcoef(self):
+        rng = np.random.RandomState(1)
+        gem = rng.normal(8, 1, (50, 30))
+        seeds = [rng.choice(30, 8, replace=False) for run in range(4)]
+        # A gene constant over the first seed has no correlation
+        gem[3, seeds[0]] = 5.0
+        gene_vecs = [rng.normal(0, 1, 8) for run in range(4)]
+        corvecs = engine.batch_corvecs(gem, seeds, gene_vecs, chunk=7)
+        for r, (seed, vec) in enumerate(zip(seeds, gene_vecs)):
+            for g in range(len(gem)):
+                if r == 0 and g == 3:
+                    self.assertTrue(np.isnan(corvecs[g, r]))
+                    continue
+                self.assertAlmostEqual(corvecs[g, r], np.corrcoef(gem[g, seed], vec)[0, 1], places=10)
+
+    def test_corvecs_agree_with_nas(self):
+        x = np.array([0.5, np.nan, -0.25])
+        self.assertTrue(engine.corvecs_agree(x, x + 1e-12))
+        self.assertFalse(engine.corvecs_agree(x, np.array([0.5, 0.1, -0.25])))
+
+
+class SeriesMatrixTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'series_matrix.txt')
+        synthetic.write_series_matrix(self.path, 60, 16, biclusters=2, bicluster_genes=10, characteristics=2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def expected_table(self):
+        with open(self.path) as f:
+            lines = f.read().split('!series_matrix_table_begin\n')[1].split('!series_matrix_table_end')[0].splitlines()
+        rows = [line.split('\t') for line in lines[1:]]
+        return [row[0].strip('"') for row in rows], np.array([[float(x) for x in row[1:]] for row in rows])
+
+    def test_parse_synthetic(self):
+        samples, sample_fields = seriesmatrix.parse(self.path, self.dir.name)
+        gem, genes, store_samples = gemstore.load(self.dir.name)
+        expected_genes, expected = self.expected_table()
+        self.assertEqual(samples, ['GSM{0:07d}'.format(i + 1) for i in range(16)])
+        self.assertEqual(store_samples, samples)
+        self.assertEqual(genes, expected_genes)
+        np.testing.assert_array_equal(gem, expected)
+        fields = dict(sample_fields)
+        self.assertEqual(fields['source_name_ch1'], ['synthetic'] * 16)
+        self.assertEqual(len([name for name, values in sample_fields if name == 'characteristics_ch1']), 4)
+
+    def test_parse_latin1(self):
+        with open(self.path) as f:
+            text = f.read()
+        with open(self.path, 'w', encoding='latin-1') as f:
+            f.write(text.replace('"synthetic"', '"5 µg"'))
+        samples, sample_fields = seriesmatrix.parse(self.path, self.dir.name)
+        self.assertEqual(dict(sample_fields)['source_name_ch1'], ['5 µg'] * 16)
+        self.assertEqual(gemstore.load(self.dir.name)[0].shape, (60, 16))
+
+
+class FindSeedTests(SimpleTestCase):
+    def test_find_seed_matches_loop(self):
+        rng = np.random.RandomState(3)
+        gem = rng.normal(8, 1, (20, 40))
+        gem[:10, :12] += np.outer(rng.choice([-1, 1], 10), rng.normal(0, 2, 12))
+        initial_seed = rng.choice(40, 8, replace=False)
+        proposals = list(engine.random_proposals(np.random.default_rng(3), 300, 40, 8))
+        # Refreshing every few swaps also checks the rebuilt sums and cross-products
+        seed = engine.find_seed(gem, 8, initial_seed, proposals, refresh=5)
+        self.assertEqual(list(seed), find_seed_loop(gem, initial_seed, proposals))
+        self.assertNotEqual(sorted(seed), sorted(initial_seed))
+
+
+class RunClusteringTests(SimpleTestCase):
+    def test_run_correlations_matches_corrcoef(self):
+        rng = np.random.RandomState(2)
+        cormat = rng.uniform(-1, 1, (200, 6))
+        cormat[[5, 70, 150], [0, 3, 5]] = np.nan
+        complete = cormat[~np.isnan(cormat).any(axis=1)]
+        expected = np.abs(np.corrcoef(complete.T))
+        np.testing.assert_allclose(engine.run_correlations(cormat, chunk=32), expected, rtol=1e-10, atol=1e-12)
+
+    def test_cluster_runs_picks_best_silhouette(self):
+        rng = np.random.RandomState(4)
+        # Three groups of runs sharing a correlation vector each
+        profiles = rng.normal(0, 1, (300, 3))
+        cormat = np.column_stack([profiles[:, g] + rng.normal(0, 0.3, 300) for g in [0] * 5 + [1] * 4 + [2] * 3])
+        cor = engine.run_correlations(cormat)
+        clusters = engine.cluster_runs(cor, 8)
+        dist = 1 - cor
+        np.fill_diagonal(dist, 0)
+        linkage = hierarchy.linkage(squareform(dist, checks=False), method='complete')
+        widths = [silhouette_loop(dist, hierarchy.cut_tree(linkage, n_clusters=k)[:, 0]) for k in range(2, 9)]
+        np.testing.assert_allclose(clusters['widths'], widths, atol=1e-12)
+        groups = [list(np.flatnonzero(group)) for group in clusters['groups']]
+        self.assertEqual(groups, [list(range(5)), list(range(5, 9)), list(range(9, 12))])
+
+    def test_cluster_runs_needs_three_runs(self):
+        with self.assertRaises(ValueError):
+            engine.cluster_runs(np.ones((2, 2)), 20)
+
+
+@override_settings(MCBICLUST_MAX_RUNNING_ANALYSES=2, MCBICLUST_MAX_RUNNING_PER_USER=1)
+class SchedulerTests(TestCase):
+    def setUp(self):
+        # Finishing or failing an analysis sends the dispatcher, there is no broker in tests
+        patcher = mock.patch('mcbiclustweb.tasks.dispatchAnalyses')
+        self.dispatch = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = timezone.now()
+
+    def queue(self, profile, minutes_ago):
+        a = make_analysis(profile)
+        scheduler.enqueue(a, {'seed_size': 10})
+        Analysis.objects.filter(id=a.id).update(queued_at=self.now - timedelta(minutes=minutes_ago))
+        return a
+
+    def test_enqueue(self):
+        a = self.queue(make_profile('a'), 0)
+        a.refresh_from_db()
+        self.assertEqual((a.stage, a.status, a.job), (3, scheduler.QUEUED_STATUS, '{"seed_size": 10}'))
+        self.assertIsNone(a.dispatched_at)
+
+    def test_users_served_in_turn_by_last_dispatched(self):
+        recent = make_profile('recent', self.now - timedelta(minutes=1))
+        older = make_profile('older', self.now - timedelta(hours=1))
+        never = make_profile('never')
+        # The user served longest ago goes first, whoever queued first
+        a_recent = self.queue(recent, 30)
+        a_older = self.queue(older, 20)
+        a_never = self.queue(never, 10)
+        self.assertEqual([claimed[0] for claimed in scheduler.claim()], [a_never.id, a_older.id])
+        a_recent.refresh_from_db()
+        self.assertIsNotNone(a_recent.queued_at)
+        for a in (a_never, a_older):
+            a.refresh_from_db()
+            self.assertEqual((a.queued_at, a.stage, a.status), (None, 3, scheduler.STARTED_STATUS))
+            self.assertIsNotNone(a.dispatched_at)
+            self.assertIsNotNone(a.user.last_dispatched)
+        self.assertEqual(scheduler.queue_position(a_recent), 1)
+
+    def test_per_user_limit(self):
+        busy = make_profile('busy')
+        idle = make_profile('idle')
+        make_analysis(busy, stage=5, dispatched_at=self.now)
+        self.queue(busy, 30)
+        self.queue(busy, 20)
+        a_idle = self.queue(idle, 10)
+        # One slot is free, the user already running an analysis waits
+        self.assertEqual([claimed[0] for claimed in scheduler.claim()], [a_idle.id])
+        self.assertEqual(scheduler.claim(), [])
+
+    @override_settings(MCBICLUST_DISPATCH_TIMEOUT=3600)
+    def test_stale_slots_reclaimed(self):
+        profile = make_profile('stale')
+        stale = make_analysis(profile, stage=7, status="7. Started analysis: plotted heatmap", dispatched_at=self.now - timedelta(hours=2))
+        running = make_analysis(make_profile('running'), stage=5, dispatched_at=self.now - timedelta(minutes=10))
+        queued = self.queue(profile, 10)
+        # The reclaimed slot is free for the same call
+        self.assertEqual([claimed[0] for claimed in scheduler.claim()], [queued.id])
+        stale.refresh_from_db()
+        self.assertEqual((stale.stage, stale.dispatched_at, stale.generation), (-4, None, 1))
+        self.assertIn("did not finish in time", stale.status)
+        running.refresh_from_db()
+        self.assertEqual((running.stage, running.generation), (5, 0))
+        self.assertIsNotNone(running.dispatched_at)
+
+    def test_set_status_frees_slot(self):
+        profile = make_profile('slots')
+        for status in ("12. Analysis completed", "-1. Failed: error finding seeds, please try to restart the analysis"):
+            a = make_analysis(profile, stage=5, dispatched_at=self.now)
+            a.set_status(status)
+            a.refresh_from_db()
+            self.assertIsNone(a.dispatched_at)
+        self.assertEqual(self.dispatch.delay.call_count, 2)
+
+    def test_set_status_keeps_slot_while_running(self):
+        a = make_analysis(make_profile('running'), stage=5, dispatched_at=self.now)
+        a.set_status("6. Started analysis: created correlation matrix")
+        a.refresh_from_db()
+        self.assertIsNotNone(a.dispatched_at)
+        self.dispatch.delay.assert_not_called()
+
+
+class CancellationTests(TestCase):
+    def setUp(self):
+        self.a = make_analysis(make_profile('cancel'), stage=5, dispatched_at=timezone.now())
+
+    @mock.patch('mcbiclustweb.cancellation.current_app')
+    def test_cancel_revokes_tracked_tasks(self, app):
+        cancellation.track(self.a.id, ['seed-1', 'seed-2'])
+        cancellation.track(self.a.id, ['analysis'])
+        cancellation.cancel(self.a)
+        app.control.revoke.assert_called_once_with(['seed-1', 'seed-2', 'analysis'])
+        self.assertEqual((self.a.generation, self.a.task_ids, self.a.dispatched_at), (1, '', None))
+
+    @mock.patch('mcbiclustweb.cancellation.current_app')
+    def test_cancel_without_tasks(self, app):
+        cancellation.cancel(self.a)
+        app.control.revoke.assert_not_called()
+        self.assertEqual(self.a.generation, 1)
+
+    @mock.patch('mcbiclustweb.cancellation.current_app')
+    def test_requested(self, app):
+        self.assertFalse(cancellation.requested(self.a.id, 0))
+        cancellation.cancel(self.a)
+        # A task of the old run stops, one of the new run carries on
+        self.assertTrue(cancellation.requested(self.a.id, 0))
+        self.assertFalse(cancellation.requested(self.a.id, 1))
+        self.assertFalse(cancellation.requested(self.a.id))
+        analysis_id = self.a.id
+        self.a.delete()
+        self.assertTrue(cancellation.requested(analysis_id, 1))
+        self.assertTrue(cancellation.requested(analysis_id))
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile = make_profile('api')
+        self.token, self.key = api.create_token(self.profile, "pipeline")
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + self.key}
+
+    def test_authentication(self):
+        url = reverse('mcbiclustweb:api_status')
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Token wrong').status_code, 401)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer ' + self.key).status_code, 401)
+        self.assertEqual(self.client.get(url, **self.auth).status_code, 200)
+
+    @override_settings(MCBICLUST_API_RATE_LIMIT=(2, 60))
+    def test_rate_limit(self):
+        url = reverse('mcbiclustweb:api_status')
+        self.assertEqual([self.client.get(url, **self.auth).status_code for i in range(3)], [200, 200, 429])
+        response = self.client.get(url, **self.auth)
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(1 <= int(response['Retry-After']) <= 61)
+        # Each token has its own count
+        other, key = api.create_token(self.profile)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Token ' + key).status_code, 200)
+
+    def test_status_only_own_analyses(self):
+        mine = make_analysis(self.profile)
+        theirs = make_analysis(make_profile('other'))
+        url = reverse('mcbiclustweb:api_status')
+        body = self.client.get(url, {'ids': '{0},{1},0'.format(theirs.id, mine.id)}, **self.auth).json()
+        self.assertEqual([a['id'] for a in body['analyses']], [mine.id])
+        self.assertEqual(body['missing'], [theirs.id, 0])
+        body = self.client.post(url, {'ids': [theirs.id, mine.id]}, content_type='application/json', **self.auth).json()
+        self.assertEqual([a['id'] for a in body['analyses']], [mine.id])
+        self.assertEqual(self.client.get(url, {'ids': 'x'}, **self.auth).status_code, 400)
+
+    @mock.patch('mcbiclustweb.api.fork_plot_render')
+    def test_fork_plot_rendering(self, render):
+        render.return_value.failed.return_value = False
+        a = make_analysis(self.profile, stage=12)
+        entry = Artifact.objects.create(analysis=a, kind='forkplot', path='forkplot_0_ER.png', bicluster=0, characteristic='ER')
+        url = reverse('mcbiclustweb:api_artifact', args=[a.id, entry.path])
+        response = self.client.get(url, **self.auth)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {'status': "rendering"})
+        self.assertEqual(response['Retry-After'], '5')
+        render.assert_called_once_with(entry)
+        render.return_value.failed.return_value = True
+        self.assertEqual(self.client.get(url, **self.auth).status_code, 404)
+
+    def test_artifact_of_other_user(self):
+        a = make_analysis(make_profile('other'), stage=12)
+        Artifact.objects.create(analysis=a, kind='heatmap', path='heatmap.png', size=10)
+        url = reverse('mcbiclustweb:api_artifact', args=[a.id, 'heatmap.png'])
+        self.assertEqual(self.client.get(url, **self.auth).status_code, 404)
+
+
+class StageCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        media = override_settings(MEDIA_ROOT=tmp.name, MCBICLUST_CACHE_MAX_BYTES=10 ** 9)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def store(self, name, age):
+        stage_key = stage_cache.key(name)
+        stage_cache.put(stage_key, {'values': np.zeros(100)})
+        path = stage_cache.entry_dir(stage_key)
+        os.utime(path, (0, 1000000 - age))
+        return stage_key, stage_cache.entry_size(path)
+
+    def test_evicts_least_recently_used(self):
+        oldest, size = self.store('oldest', 30)
+        middle, size = self.store('middle', 20)
+        newest, size = self.store('newest', 10)
+        self.assertEqual(stage_cache.evict(2 * size), 2 * size)
+        self.assertEqual([stage_cache.get(k) is not None for k in (oldest, middle, newest)], [False, True, True])
+        self.assertEqual(stage_cache.evict(0), 0)
+        self.assertIsNone(stage_cache.get(newest))
+
+    def test_get_marks_use(self):
+        older, size = self.store('older', 30)
+        newer, size = self.store('newer', 10)
+        path = stage_cache.get(older)
+        self.assertGreater(os.path.getmtime(path), 1000000)
+        self.assertEqual(set(stage_cache.arrays(path)), {'values'})
+        stage_cache.evict(size)
+        self.assertIsNotNone(stage_cache.get(older))
+        self.assertIsNone(stage_cache.get(newer))
+
+    def test_put_evicts_over_budget(self):
+        first, size = self.store('first', 30)
+        second, size = self.store('second', 20)
+        with override_settings(MCBICLUST_CACHE_MAX_BYTES=2 * size):
+            third, size = self.store('third', 10)
+        self.assertIsNone(stage_cache.get(first))
+        self.assertIsNotNone(stage_cache.get(second))
+        self.assertIsNotNone(stage_cache.get(third))
+
+
+class CheckpointTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store_dir = tmp.name
+
+    def test_load_saved(self):
+        checkpoint.reset(self.store_dir, 'run')
+        checkpoint.save(self.store_dir, 'corvecs', 'stage', {'corvecs': np.arange(6).reshape(2, 3)})
+        loaded = checkpoint.load(self.store_dir, 'corvecs', 'stage')
+        self.assertEqual(set(loaded), {'corvecs'})
+        np.testing.assert_array_equal(loaded['corvecs'], np.arange(6).reshape(2, 3))
+        self.assertIsNone(checkpoint.load(self.store_dir, 'pc1', 'stage'))
+
+    def test_other_key_ignored(self):
+        checkpoint.reset(self.store_dir, 'run')
+        checkpoint.save(self.store_dir, 'corvecs', 'stage', {'corvecs': np.ones(3)})
+        self.assertIsNone(checkpoint.load(self.store_dir, 'corvecs', 'other stage'))
+
+    def test_reset(self):
+        checkpoint.reset(self.store_dir, 'run')
+        checkpoint.save(self.store_dir, 'corvecs', 'stage', {'corvecs': np.ones(3)})
+        # The same run resumes, a run with other inputs starts over
+        checkpoint.reset(self.store_dir, 'run')
+        self.assertIsNotNone(checkpoint.load(self.store_dir, 'corvecs', 'stage'))
+        checkpoint.reset(self.store_dir, 'other run')
+        self.assertIsNone(checkpoint.load(self.store_dir, 'corvecs', 'stage'))
+        self.assertEqual(os.listdir(checkpoint.checkpoint_dir(self.store_dir)), [checkpoint.RUN_FILE])
+
+
+@override_settings(MCBICLUST_INDEX_PAGE_SIZE=2)
+class IndexPaginationTests(TestCase):
+    def setUp(self):
+        profile = make_profile('index')
+        self.ids = [make_analysis(profile).id for i in range(5)]
+        make_analysis(make_profile('other'))
+        self.client.force_login(profile.user)
+
+    def page(self, **params):
+        # Only the page the view picks is checked, not the template
+        with mock.patch('mcbiclustweb.views.render', return_value=HttpResponse()) as render:
+            self.client.get(reverse('mcbiclustweb:index'), params)
+        context = render.call_args[0][2]
+        return [a.id for a in context['analyses']], context['has_previous'], context['has_next']
+
+    def test_after(self):
+        ids = self.ids
+        self.assertEqual(self.page(), (ids[0:2], False, True))
+        self.assertEqual(self.page(after=ids[1]), (ids[2:4], True, True))
+        self.assertEqual(self.page(after=ids[3]), (ids[4:], True, False))
+        self.assertEqual(self.page(after=ids[4]), ([], False, False))
+
+    def test_before(self):
+        ids = self.ids
+        self.assertEqual(self.page(before=ids[4]), (ids[2:4], True, True))
+        # The first page is reached exactly at the boundary
+        self.assertEqual(self.page(before=ids[2]), (ids[0:2], False, True))
+        self.assertEqual(self.page(before=ids[1]), (ids[0:1], False, True))
+        self.assertEqual(self.page(before=ids[0]), ([], False, False))
+
+    def test_filters(self):
+        Analysis.objects.filter(id__in=self.ids[1:4]).update(stage=12)
+        self.assertEqual(self.page(status='completed'), (self.ids[1:3], False, True))
+        self.assertEqual(self.page(status='completed', after=self.ids[2]), (self.ids[3:4], True, False))
+        self.assertEqual(self.page(stage=2), ([self.ids[0], self.ids[4]], False, False))
+
+
+class LookupTests(SimpleTestCase):
+    NAMES = ['TP53', 'BRCA1', 'brca1', 'Gata3', 'MYC']
+    ALIASES = ['P53\tTP53', 'ERBB\tNOTINGEM', 'ERBB\tMYC', 'GATA\tgata3', 'MYC\tTP53', 'bad line']
+
+    def setUp(self):
+        self.index = lookup.build(self.NAMES)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.alias_path = os.path.join(tmp.name, 'aliases.tsv')
+        with open(self.alias_path, 'w') as f:
+            f.write('\n'.join(self.ALIASES) + '\n')
+        self.addCleanup(lookup.aliases.cache_clear)
+
+    def test_resolve(self):
+        aliases = lookup.aliases(self.alias_path)
+        cases = [
+            # name, ignore_case, with aliases, row
+            ('BRCA1', False, False, 1),
+            ('brca1', False, False, 2),
+            ('tp53', False, False, None),
+            ('tp53', True, False, 0),
+            ('GATA3', True, False, 3),
+            # Names only differing in case in the GEM have to match exactly
+            ('Brca1', True, False, None),
+            ('P53', False, False, None),
+            ('P53', False, True, 0),
+            ('p53', False, True, None),
+            ('p53', True, True, 0),
+            # Every symbol of an alias is tried in file order
+            ('ERBB', False, True, 4),
+            ('GATA', False, True, None),
+            ('GATA', True, True, 3),
+            # An exact match wins over an alias
+            ('MYC', False, True, 4),
+            ('NOTINGEM', True, True, None),
+        ]
+        for name, ignore_case, with_aliases, row in cases:
+            with self.subTest(name=name, ignore_case=ignore_case, aliases=with_aliases):
+                rows, missing = lookup.resolve(self.index, [name], ignore_case, aliases if with_aliases else None)
+                self.assertEqual(rows, [row])
+                self.assertEqual(missing, [name] if row is None else [])
+
+    def test_resolve_many(self):
+        rows, missing = lookup.resolve(self.index, ['MYC', 'p53', 'TP53', 'nope'], True, lookup.aliases(self.alias_path))
+        self.assertEqual(rows, [4, 0, 0, None])
+        self.assertEqual(missing, ['nope'])
+
+    def test_aliases(self):
+        aliases = lookup.aliases(self.alias_path)
+        self.assertEqual(aliases['symbols'], ['TP53', 'NOTINGEM', 'MYC', 'gata3', 'TP53'])
+        self.assertEqual(aliases['exact'], {'P53': [0], 'ERBB': [1, 2], 'GATA': [3], 'MYC': [4]})
+        self.assertEqual(aliases['folded']['erbb'], [1, 2])
+        self.assertIs(lookup.aliases(self.alias_path), aliases)
+        self.assertIsNone(lookup.aliases(''))
+
+    def test_missing_message(self):
+        genes = ['TP53', 'BRCA1', 'GATA3', 'ESR1', 'FOXA1']
+        cases = [
+            (genes, 100, "Genes not found: TP53, BRCA1, GATA3, ESR1, FOXA1"),
+            (genes, 48, "Genes not found: TP53, BRCA1, GATA3, ESR1, FOXA1"),
+            (genes, 47, "Genes not found: TP53, BRCA1, GATA3 and 2 more"),
+            (genes, 45, "Genes not found: TP53, BRCA1 and 3 more"),
+            (genes, 39, "Genes not found: TP53, BRCA1 and 3 more"),
+            (genes, 38, "Genes not found: TP53 and 4 more"),
+        ]
+        for missing, max_length, message in cases:
+            with self.subTest(missing=missing, max_length=max_length):
+                self.assertEqual(lookup.missing_message("Genes not found", missing, max_length), message)
+
+
+class CostModelTests(TestCase):
+    def test_fit(self):
+        # Rows recorded from known costs are fitted back to them
+        for genes, samples, seed_size, iterations in [(10, 40, 5, 100), (50, 40, 10, 100), (20, 60, 8, 500), (80, 100, 20, 1000), (30, 20, 4, 50)]:
+            StageMetric.objects.create(stage='findseed', genes=genes, samples=samples, seed_size=seed_size, iterations=iterations,
+                                       wall_time=2 + 0.01 * iterations + 1e-4 * iterations * genes * seed_size, cpu_time=0,
+                                       peak_rss=1000 + 5 * genes * samples + 2 * genes)
+        for genes, samples, runs in [(1000, 40, 10), (5000, 100, 20), (2000, 60, 50)]:
+            StageMetric.objects.create(stage='cormat', genes=genes, samples=samples, runs=runs, wall_time=1 + 1e-6 * genes * samples * runs,
+                                       cpu_time=0, peak_rss=2000 + genes * samples + 3 * genes * runs)
+        # Too few rows to fit
+        StageMetric.objects.create(stage='cvplot', genes=1000, samples=40, wall_time=1, cpu_time=0, peak_rss=1000)
+        model = costmodel.fit()
+        self.assertEqual(set(model), {'findseed', 'cormat'})
+        np.testing.assert_allclose(model['findseed']['time'], [2, 0.01, 1e-4], rtol=1e-6)
+        np.testing.assert_allclose(model['findseed']['memory'], [1000, 5, 2], rtol=1e-6)
+        np.testing.assert_allclose(model['cormat']['time'], [1, 1e-6], rtol=1e-6)
+        np.testing.assert_allclose(model['cormat']['memory'], [2000, 1, 3], rtol=1e-6)
+
+        with override_settings(MCBICLUST_SEED_WORKERS=2):
+            e = costmodel.predict(model, 1000, 40, 20, 10, 100, 4)
+        run_time = 2 + 1 + 1e-4 * 100 * 20 * 10
+        cormat = 1 + 1e-6 * 1000 * 40 * 4
+        self.assertAlmostEqual(e['compute'], 4 * run_time + cormat)
+        self.assertAlmostEqual(e['runtime'], 2 * run_time + cormat)
+        self.assertAlmostEqual(e['memory'], 2000 + 1000 * 40 + 3 * 1000 * 4)
+        self.assertFalse(e['complete'])
+        self.assertIsNone(costmodel.predict({}, 1000, 40, 20, 10, 100, 4))
+
+    def test_fit_keeps_coefficients_non_negative(self):
+        for genes in [10, 20, 30, 40]:
+            StageMetric.objects.create(stage='cvplot', genes=genes, samples=40, wall_time=100 - genes, cpu_time=0, peak_rss=1000)
+        self.assertTrue(all(c >= 0 for c in costmodel.fit()['cvplot']['time']))
+
+    @override_settings(MCBICLUST_COMPUTE_BUDGETS={'normal': {'confirm': 100, 'daily': 1000, 'memory': 5000}})
+    def test_admit(self):
+        profile = make_profile('budget')
+        a = make_analysis(profile)
+        self.assertEqual(costmodel.admit(a, None), ('ok', ""))
+        self.assertEqual(costmodel.admit(a, {'compute': 50, 'memory': 1000}), ('ok', ""))
+        self.assertEqual(costmodel.admit(a, {'compute': 500, 'memory': 1000})[0], 'confirm')
+        self.assertEqual(costmodel.admit(a, {'compute': 50, 'memory': 6000})[0], 'refuse')
+        # Over what is left of the daily budget once today's work is counted
+        StageMetric.objects.create(analysis=make_analysis(profile), stage='findseed', wall_time=900, cpu_time=0, peak_rss=1000)
+        decision, message = costmodel.admit(a, {'compute': 150, 'memory': 1000})
+        self.assertEqual(decision, 'refuse')
+        self.assertIn("100 seconds of your daily budget is left", message)
+        self.assertEqual(costmodel.admit(a, {'compute': 50, 'memory': 1000}), ('ok', ""))
@@ -1,15 +1,25 @@
 from django.urls import path
 
 from django.contrib.auth import views as auth_views
-from . import views
+from . import api, views
 
 app_name = 'mcbiclustweb'
 urlpatterns = [
     path('', views.IndexView.as_view(), name='index'),
     path('analysis/<int:analysis_id>', views.analysis, name="analysis"),
+    path('analysis/<int:analysis_id>/estimate', views.estimate, name="estimate"),
+    path('analysis/<int:analysis_id>/progress', views.progress, name="progress"),
+    path('analysis/<int:analysis_id>/forkplot/<int:bicluster>/<str:char>', views.fork_plot, name="forkplot"),
     path('register/', views.RegisterFormView.as_view(), name='register'),
     path('login/', auth_views.LoginView.as_view(template_name='mcbiclustweb/login.html', redirect_authenticated_user=True), name='login'),
     path('logout/', auth_views.LogoutView.as_view(template_name='mcbiclustweb/logout.html'), name='logout'),
     path('analysis/<int:analysis_id>/start', views.start, name="start"),
     path('analysis/<int:analysis_id>/delete', views.delete, name="delete"),
+    path('analysis/<int:analysis_id>/sweep', views.sweep_results, name="sweep"),
+    path('analysis/<int:analysis_id>/sweep/start', views.start_sweep, name="start_sweep"),
+    path('api/analyses', api.create, name="api_create"),
+    path('api/analyses/status', api.status, name="api_status"),
+    path('api/analyses/<int:analysis_id>/start', api.start, name="api_start"),
+    path('api/analyses/<int:analysis_id>/artifacts', api.artifacts, name="api_artifacts"),
+    path('api/analyses/<int:analysis_id>/artifacts/<path:path>', api.artifact, name="api_artifact"),
 ]
\ No newline at end of file
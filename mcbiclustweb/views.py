@@ -1,13 +1,15 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, FileResponse, Http404, JsonResponse, HttpResponseNotModified
 from django.urls import reverse
 from django.templatetags.static import static
 from django.conf import settings
 from django.contrib.auth import authenticate, login
 from django.views.generic import View
-import os, shutil
+import os, shutil, json, hashlib
+from urllib.parse import urlencode
 
-from mcbiclustweb.models import Profile, Analysis
+from mcbiclustweb.models import Profile, Analysis, Artifact
+from mcbiclustweb import cancellation, costmodel, manifest, scheduler, sweep
 
 from .forms import RegisterForm, CreateAnalysisForm
 
@@ -50,6 +52,16 @@ class RegisterFormView(View):
 
         return render(request, self.template_name, {'form': form})
 
+# Columns shown on the index page, and the stages each status filter covers
+INDEX_FIELDS = ['id', 'name', 'description', 'status', 'stage', 'gem', 'date_started']
+STATUS_FILTERS = {
+    'preprocessing': {'stage': 1},
+    'ready': {'stage': 2},
+    'running': {'stage__gte': 3, 'stage__lt': 12},
+    'completed': {'stage': 12},
+    'failed': {'stage__lt': 0},
+}
+
 class IndexView(View):
     form_class = CreateAnalysisForm
     template_name = 'mcbiclustweb/index.html'
@@ -57,9 +69,44 @@ class IndexView(View):
     def get(self, request):
         if request.user.is_authenticated:
             # form = self.form_class(None)
-            profile = Profile.objects.get(user=self.request.user)
-            a = Analysis.objects.order_by('id').filter(user=profile)
-            return render(request, self.template_name, {'analyses': a})
+            # The Profile id is looked up once so the page queries filter on the (user, id) index directly
+            profile_id = Profile.objects.filter(user=self.request.user).values_list('id', flat=True).first()
+            analyses = Analysis.objects.filter(user_id=profile_id).only(*INDEX_FIELDS)
+            stage = request.GET.get('stage', '')
+            status = request.GET.get('status', '')
+            if stage.lstrip('-').isdigit():
+                analyses = analyses.filter(stage=int(stage))
+            if status in STATUS_FILTERS:
+                analyses = analyses.filter(**STATUS_FILTERS[status])
+
+            # Keyset pagination on (user, id): a page starts after or ends before an id, so
+            # each page is one index range scan however many analyses come before it
+            page_size = settings.MCBICLUST_INDEX_PAGE_SIZE
+            before = request.GET.get('before', '')
+            after = request.GET.get('after', '')
+            if before.isdigit():
+                page = list(analyses.filter(id__lt=int(before)).order_by('-id')[:page_size + 1])
+                has_previous = len(page) > page_size
+                page = page[:page_size][::-1]
+                has_next = True
+            else:
+                if after.isdigit():
+                    analyses = analyses.filter(id__gt=int(after))
+                page = list(analyses.order_by('id')[:page_size + 1])
+                has_next = len(page) > page_size
+                page = page[:page_size]
+                has_previous = after.isdigit()
+
+            return render(request, self.template_name, {
+                'analyses': page,
+                'has_next': has_next and bool(page),
+                'has_previous': has_previous and bool(page),
+                'previous_before': page[0].id if page else '',
+                'next_after': page[-1].id if page else '',
+                'filters': urlencode({k: v for k, v in [('stage', stage), ('status', status)] if v}),
+                'status': status,
+                'statuses': list(STATUS_FILTERS),
+            })
         else:
             return redirect('mcbiclustweb:login')
 
@@ -78,7 +125,8 @@ class IndexView(View):
                 #     shutil.rmtree(os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/None'.format(analysis.user.id)))
                 # except:
                 #     pass
-                preprocess.delay(analysis.id)
+                result = preprocess.delay(analysis.id)
+                cancellation.track(analysis.id, [result.id])
 
                 return redirect('mcbiclustweb:index')
             else:
@@ -88,41 +136,143 @@ class IndexView(View):
 
 def analysis(request, analysis_id):
     a = Analysis.objects.get(id=analysis_id)
-    status = int(a.status.split('.')[0])
+    status = a.stage
     fig_dir_url = os.path.join(settings.MEDIA_URL, *a.gem.name.split("/")[:-1])
     fig_dir_root = os.path.join(settings.MEDIA_ROOT, *a.gem.name.split("/")[:-1])
     
-    nbiclusters = 0
+    # Figures come from the artifact manifest, the analysis directory is never listed. Biclusters
+    # that could not be extended have no fork plots, so the numbers can have gaps.
+    heatmap = False
+    silhouettes = []
+    plot_biclusters = 0
+    nbiclusters = []
     chars = []
-    if status >= 11:
-        nbiclusters = sum(os.path.isdir(os.path.join(fig_dir_root, i)) for i in os.listdir(fig_dir_root))
-
-        fork_dir = os.path.join(fig_dir_root, "1")
-        for i in os.listdir(fork_dir):
-            chars.append(i[9:-4])
+    for kind, path, bicluster, characteristic in Artifact.objects.filter(analysis=a, kind__in=['heatmap', 'silhouette', 'plotdata', 'forkplot']).values_list('kind', 'path', 'bicluster', 'characteristic'):
+        if kind == 'heatmap':
+            heatmap = True
+        elif kind == 'silhouette':
+            silhouettes.append(path)
+        elif kind == 'plotdata':
+            plot_biclusters = max(plot_biclusters, bicluster)
+        elif status >= 11 and a.char_ok:
+            if bicluster not in nbiclusters:
+                nbiclusters.append(bicluster)
+            if bicluster == nbiclusters[0]:
+                chars.append(characteristic.replace(".", "_"))
     
-    return render(request, "mcbiclustweb/analysis.html", {'analysis': a, 'status': status, 'fig_dir': fig_dir_url, 'nbiclusters': range(1, nbiclusters + 1), 'chars': chars})
+    return render(request, "mcbiclustweb/analysis.html", {'analysis': a, 'status': status, 'fig_dir': fig_dir_url, 'queue_position': scheduler.queue_position(a), 'heatmap': heatmap, 'silhouettes': silhouettes, 'plot_biclusters': range(1, plot_biclusters + 1), 'nbiclusters': sorted(nbiclusters), 'chars': chars,
+                                                          'has_sweep': a.combinations.exists()})
+
+def progress(request, analysis_id):
+    # Polled by the analysis page: a few columns of one row, and 304 while nothing has changed
+    a = Analysis.objects.filter(id=analysis_id).only('user_id', 'stage', 'status', 'progress_done', 'progress_total', 'queued_at').first()
+    if a is None:
+        raise Http404("Analysis not found")
+    values = {'stage': a.stage, 'status': a.status, 'progress_done': a.progress_done, 'progress_total': a.progress_total, 'queue_position': scheduler.queue_position(a)}
+    etag = '"%s"' % hashlib.md5(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(values)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def estimate(request, analysis_id):
+    # Predicted cost of starting the analysis with the parameters in the form
+    a = Analysis.objects.get(id=analysis_id)
+    try:
+        params = [int(request.GET[k]) for k in ['seedSize', 'iterations', 'numRuns', 'genesetSize']]
+    except (KeyError, ValueError):
+        return JsonResponse({'estimate': None, 'decision': 'ok', 'message': ""})
+    e = costmodel.estimate(a, *params)
+    decision, message = costmodel.admit(a, e)
+    if e is not None:
+        e = dict(e, compute_text=costmodel.duration(e['compute']), runtime_text=costmodel.duration(e['runtime']))
+    return JsonResponse({'estimate': e, 'decision': decision, 'message': message})
+
+def fork_plot(request, analysis_id, bicluster, char):
+    a = Analysis.objects.get(id=analysis_id)
+    fig_dir_root = os.path.join(settings.MEDIA_ROOT, *a.gem.name.split("/")[:-1])
+    artifact = Artifact.objects.filter(analysis=a, kind='forkplot', path=manifest.fork_plot_path(bicluster, char)).first()
+    if artifact is None:
+        raise Http404("Fork plot not found")
+    plot = os.path.join(fig_dir_root, artifact.path)
+
+    # Fork plots not rendered yet are sent to a worker on first request and kept. The request
+    # never waits for the render, the page gets a 503 and asks again.
+    if artifact.size is None:
+        if fork_plot_render(artifact).failed():
+            raise Http404("Fork plot could not be rendered")
+        response = HttpResponse("Fork plot is being rendered", status=503)
+        response['Retry-After'] = '5'
+        return response
+
+    return FileResponse(open(plot, 'rb'), content_type='image/png')
 
 def start(request, analysis_id):
     a = Analysis.objects.get(id=analysis_id)
-    a.status = "3. Started analysis"
-    a.save()
 
     seed_size = int(request.POST['seedSize'])
     init_seed = request.POST['initSeed']
     iterations = int(request.POST['iterations'])
     num_runs = int(request.POST['numRuns'])
     geneset_file = request.FILES['geneset']
-    geneset = geneset_file.read().decode("utf-8").split(',')
+    geneset = [gene.strip() for gene in geneset_file.read().decode("utf-8").split(',') if gene.strip()]
+
+    # Admission control on the predicted cost of the analysis
+    decision, message = costmodel.admit(a, costmodel.estimate(a, seed_size, iterations, num_runs, len(geneset)))
+    if decision == 'refuse' or (decision == 'confirm' and not request.POST.get('confirmCost')):
+        messages.error(request, message)
+        return redirect('mcbiclustweb:analysis', analysis_id=analysis_id)
 
-    runFindSeed.delay(analysis_id, seed_size, init_seed, geneset, iterations, num_runs)
+    # A run still going is stopped first, then the analysis waits in the queue for a free
+    # slot, shared in turn between users
+    cancellation.cancel(a)
+    scheduler.enqueue(a, {'seed_size': seed_size, 'init_seed': init_seed, 'geneset': geneset, 'iterations': iterations, 'num_runs': num_runs})
+    dispatchAnalyses.delay()
 
     return redirect('mcbiclustweb:analysis', analysis_id=analysis_id)
+
+def start_sweep(request, analysis_id):
+    a = Analysis.objects.get(id=analysis_id)
+
+    try:
+        seed_sizes = sweep.parse_values(request.POST['seedSizes'])
+        iterations = sweep.parse_values(request.POST['iterationsList'])
+        num_runs = sweep.parse_values(request.POST['numRunsList'])
+    except (KeyError, ValueError):
+        messages.error(request, "Seed sizes, iterations and numbers of runs must be positive integers separated by commas")
+        return redirect('mcbiclustweb:analysis', analysis_id=analysis_id)
+    genesets = [(f.name, [gene.strip() for gene in f.read().decode("utf-8").split(',') if gene.strip()]) for f in request.FILES.getlist('genesets')]
+    jobs = sweep.jobs(seed_sizes, iterations, num_runs, genesets)
+    if not jobs or len(jobs) > settings.MCBICLUST_MAX_SWEEP_COMBINATIONS:
+        messages.error(request, "A parameter sweep needs at least one gene set and at most {0} combinations, {1} were given".format(settings.MCBICLUST_MAX_SWEEP_COMBINATIONS, len(jobs)))
+        return redirect('mcbiclustweb:analysis', analysis_id=analysis_id)
+
+    # Admission control on the combinations together
+    decision, message = costmodel.admit(a, sweep.estimate(a, jobs))
+    if decision == 'refuse' or (decision == 'confirm' and not request.POST.get('confirmCost')):
+        messages.error(request, message)
+        return redirect('mcbiclustweb:analysis', analysis_id=analysis_id)
+
+    for number, job in enumerate(jobs, 1):
+        scheduler.enqueue(sweep.create(a, job, number), job)
+    dispatchAnalyses.delay()
+
+    return redirect('mcbiclustweb:sweep', analysis_id=analysis_id)
+
+def sweep_results(request, analysis_id):
+    a = Analysis.objects.get(id=analysis_id)
+    return render(request, "mcbiclustweb/sweep.html", {'analysis': a, 'combinations': sweep.compare(a)})
     
 def delete(request, analysis_id):
     a = Analysis.objects.get(id=analysis_id)
     user_id = a.user.id
+    # Tasks not started yet are revoked, running ones stop at their next check once the row is gone
+    cancellation.cancel(a)
     a.delete()
+    dispatchAnalyses.delay()
 
     try:
         shutil.rmtree(os.path.join(settings.MEDIA_ROOT, 'analyses/user_{0}/{1}'.format(user_id, analysis_id)))
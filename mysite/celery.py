@@ -1,9 +1,37 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_process_init, task_prerun, task_postrun
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
 app = Celery('mysite')
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def load_r(**kwargs):
+    # Import the R libraries once per worker process instead of once per task
+    from mcbiclustweb import rruntime
+    rruntime.load()
+
+
+@task_postrun.connect
+def check_r(**kwargs):
+    # Replacing processes after CELERY_WORKER_MAX_TASKS_PER_CHILD tasks or above
+    # CELERY_WORKER_MAX_MEMORY_PER_CHILD is left to the pool, this catches a broken R session.
+    # The process is only marked here, exiting before the finished task is acknowledged would
+    # have it delivered and run again.
+    from mcbiclustweb import rruntime
+    if not rruntime.healthy():
+        rruntime.unhealthy = True
+
+
+@task_prerun.connect
+def recycle_r(**kwargs):
+    # A process marked after its last task exits before starting the next one, which is
+    # delivered again to another process as it was never started
+    from mcbiclustweb import rruntime
+    if rruntime.unhealthy:
+        rruntime.recycle()
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django_cleanup',
+    'django_celery_results',
 ]
 
 MIDDLEWARE = [
@@ -134,4 +135,134 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
 LOGIN_REDIRECT_URL = '/'
 
-CELERY_BROKER_URL = 'amqp://localhost'
\ No newline at end of file
+CELERY_BROKER_URL = 'amqp://localhost'
+CELERY_RESULT_BACKEND = 'django-db'
+
+# Separate queues so preprocessing and plotting are not stuck behind seed searches, each
+# served by its own workers, e.g. "celery -A mysite worker -Q seeds". The default "celery"
+# queue takes the dispatcher, which celery beat also runs every minute, the cache eviction
+# celery beat runs every 10 minutes and failAnalysis.
+CELERY_TASK_ROUTES = {
+    'mcbiclustweb.tasks.preprocess': {'queue': 'preprocess'},
+    'mcbiclustweb.tasks.runFindSeed': {'queue': 'seeds'},
+    'mcbiclustweb.tasks.findSeedRun': {'queue': 'seeds'},
+    'mcbiclustweb.tasks.sendSeedRuns': {'queue': 'seeds'},
+    'mcbiclustweb.tasks.runAnalysis': {'queue': 'seeds'},
+    'mcbiclustweb.tasks.sortBicluster': {'queue': 'seeds'},
+    'mcbiclustweb.tasks.finishBiclusters': {'queue': 'seeds'},
+    'mcbiclustweb.tasks.renderForkPlot': {'queue': 'plots'},
+    'mcbiclustweb.tasks.finishAnalysis': {'queue': 'plots'},
+}
+CELERY_BEAT_SCHEDULE = {
+    'dispatch-analyses': {'task': 'mcbiclustweb.tasks.dispatchAnalyses', 'schedule': 60.0},
+    'evict-cache': {'task': 'mcbiclustweb.tasks.evictCache', 'schedule': 600.0},
+}
+# Workers take one task at a time, so runs of the analyses sharing the seeds queue interleave
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Started analyses are queued and run at most this many at once, and this many per user.
+# Free slots go to the users with queued analyses in turn.
+MCBICLUST_MAX_RUNNING_ANALYSES = 4
+MCBICLUST_MAX_RUNNING_PER_USER = 1
+
+# Seconds after which an analysis still holding its slot is failed and the slot reclaimed, for
+# analyses whose worker was lost without any task failing
+MCBICLUST_DISPATCH_TIMEOUT = 24 * 3600
+
+# Worker processes serving the seeds queue, for the wall clock estimate of an analysis
+MCBICLUST_SEED_WORKERS = 4
+
+# Limits per Profile.user_type on the estimated cost of a started analysis, in worker seconds
+# (wall time of its tasks) and KB of memory. Above 'confirm' the user has to confirm, above
+# what is left of 'daily' (used in the last day plus queued) or above 'memory' it is refused.
+MCBICLUST_COMPUTE_BUDGETS = {
+    'normal': {'confirm': 3600, 'daily': 24 * 3600, 'memory': 4000000},
+}
+
+# Most combinations one parameter sweep can start, each becomes an analysis in the queue
+MCBICLUST_MAX_SWEEP_COMBINATIONS = 24
+
+# JSON API under /api/: requests per API token per window of seconds, counted in the Django
+# cache (configure a shared cache backend when running several web processes), and the most
+# analysis ids one status request can ask for. Tokens are made with manage.py apitoken.
+MCBICLUST_API_RATE_LIMIT = (120, 60)
+MCBICLUST_API_MAX_IDS = 1000
+
+# Run each FindSeed run as its own Celery subtask and merge them with a chord.
+# When False the runs are executed one after another inside runFindSeed.
+MCBICLUST_FINDSEED_FANOUT = True
+
+# Sort the samples of each bicluster and align its PC1 in its own Celery subtask, gathered in
+# bicluster order by a chord. When False the biclusters are done one after another in runAnalysis.
+# Either way a bicluster that fails is left out and the others are kept.
+MCBICLUST_BICLUSTER_FANOUT = True
+
+# Engine for the per run correlation vectors: 'numpy' computes all runs in one batched pass,
+# 'r' calls MCbiclust's CVEval run by run. The first MCBICLUST_CVEVAL_CHECK_RUNS runs of the
+# numpy engine are compared against CVEval, and the R path is used if they disagree.
+MCBICLUST_CVEVAL_ENGINE = 'numpy'
+MCBICLUST_CVEVAL_CHECK_RUNS = 1
+
+# Engine for the run x run correlations behind the heatmap and the cluster groups: 'numpy'
+# computes them once, clusters the runs with complete linkage and scores every number of
+# clusters by silhouette width itself, and draws the heatmap with the same tree. 'r' uses
+# heatmap.2 and MCbiclust's SilhouetteClustGroups, which each cluster the runs.
+MCBICLUST_CLUSTER_ENGINE = 'numpy'
+
+# Precision of the binary GEM store written by preprocess ('float64' or 'float32')
+MCBICLUST_GEM_DTYPE = 'float64'
+
+# Low memory mode for large series: the GEM store is float32 whatever MCBICLUST_GEM_DTYPE says,
+# and runAnalysis never copies the whole GEM into R. The correlation vectors always use the
+# numpy engine without the CVEval check, and the top genes and seed of each bicluster are
+# picked in NumPy instead of by MultiSampleSortPrep. PC1Align only gets the rows of the genes
+# in each bicluster. Peak RSS of each stage is kept in StageMetric to compare the two modes.
+MCBICLUST_LOW_MEMORY = False
+
+# Worker processes keep R and its libraries loaded between tasks. A process, and the R
+# session in it, is replaced after this many tasks or once it holds more than this many KB.
+CELERY_WORKER_MAX_TASKS_PER_CHILD = 100
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = 4000000
+
+# Disk budget of the stage result cache in MEDIA_ROOT/cache, least recently used entries
+# are removed beyond it every 10 minutes by celery beat, so it can be exceeded by what is
+# cached in between
+MCBICLUST_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+# Tasks are acknowledged once they finish, so the task of a worker that crashes is delivered
+# again and resumes from the analysis checkpoints. RabbitMQ also delivers again a task not
+# acknowledged within its consumer_timeout (30 minutes by default), so set consumer_timeout
+# in rabbitmq.conf above the longest task, e.g. consumer_timeout = 86400000 to match
+# MCBICLUST_DISPATCH_TIMEOUT.
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+
+# Read uploaded series matrices with the streaming parser, GEOquery is used for files it
+# cannot handle or for every file when False
+MCBICLUST_NATIVE_PARSER = True
+
+# Engine for the FindSeed runs: 'numpy' keeps the seed's sums and cross-products and updates
+# them per swap, 'r' calls MCbiclust's FindSeed. Both draw the same swaps from R's generator.
+# Runs below MCBICLUST_FINDSEED_CHECK_RUNS are done first, in a chord of their own, and also in
+# R. If they differ the R seed is kept and every other run on the same inputs uses R.
+MCBICLUST_FINDSEED_ENGINE = 'numpy'
+MCBICLUST_FINDSEED_CHECK_RUNS = 1
+
+# The analysis page draws the CV and fork plots in the browser from compact plot data. With
+# MCBICLUST_PNG_PLOTS the CVPlot PNG is rendered too, and fork plot PNGs are rendered as below,
+# otherwise fork plot PNGs are only rendered when one is downloaded.
+MCBICLUST_PNG_PLOTS = False
+
+# 'eager' renders every fork plot in parallel when the analysis finishes, 'lazy' renders each
+# one the first time it is viewed and keeps it. Until it is rendered the page is answered 503
+# and asks again, the API 202.
+MCBICLUST_FORK_PLOTS = 'lazy'
+
+# Gene set genes and initial seed samples are matched to the GEM exactly, then ignoring case
+# if MCBICLUST_MATCH_IGNORE_CASE, then (genes only) through MCBICLUST_GENE_ALIASES if set: a
+# tab separated file of alias and official symbol per line, such as HGNC previous symbols.
+MCBICLUST_MATCH_IGNORE_CASE = False
+MCBICLUST_GENE_ALIASES = ''
+
+# Analyses listed per page on the index page
+MCBICLUST_INDEX_PAGE_SIZE = 25